@@ -0,0 +1,28 @@
+# Move devices shipped more than --days ago, and scrapped devices, into the archive tables together
+# with their tests; run it from cron so the working tables only hold work in progress
+#
+#   python archive.py
+#   python archive.py --days 90 --dry-run
+
+import argparse
+import sys
+from xdatabyte import session, archive_devices, archivable_devices_query, RETENTION_DAYS, ARCHIVE_CHUNK_SIZE
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive shipped and scrapped devices in contec_tracks.db")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS, help="archive devices shipped more than this many days ago")
+    parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE, help="devices moved per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only count the devices that would be archived")
+    args = parser.parse_args(argv)
+    
+    if args.dry_run:
+        print(f"{archivable_devices_query(session, args.days).count()} devices would be archived")
+        return 0
+    
+    devices, tests = archive_devices(session, args.days, args.chunk_size,
+                                     progress=lambda done: print(f"{done} devices archived", file=sys.stderr))
+    print(f"{devices} devices and {tests} tests archived")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
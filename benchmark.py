@@ -0,0 +1,329 @@
+# Synthetic data generator and page benchmark for the devices/tests schema
+#
+#   python benchmark.py generate bench.db --tests 1000000 --seed 7
+#   python benchmark.py run bench.db --repeat 5 --json bench.json
+#   python benchmark.py run bench.db --compare bench.json      # exits 1 on regressions
+#
+# Every page scenario below makes the same data calls as the matching section of main(),
+# so a change that slows a page down shows up here before it reaches the warehouse floor.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from xdatabyte import (
+    Device, Test, TEST_TYPES, TEST_LOCATIONS, DEVICE_GRID_COLUMNS, TEST_GRID_COLUMNS,
+    BatchLedgerLine, BatchLedger, create_app_engine, get_query_cache, generate_batch_number,
+    calculate_storage_days_category, write_batch_ledger, fetch_grid_page, format_grid_page,
+    search_devices, count_devices, device_serials,
+    pending_test_summary, search_serials, device_timeline, device_summary_frame, ledger_revenue_by,
+    ledger_frame, ledger_totals, build_analytics_snapshot, load_analytics_snapshot, open_analytics_snapshot,
+    count_by, test_completion_counts, test_counts_by_model, average_rate_by_test_type, rate_tax_density,
+    test_throughput, revenue_over_time, top_n,
+    device_days_in_system, device_report_frame, test_report_frame, func, select
+)
+
+MODELS = [("DCX3200", 30), ("DCX3510", 20), ("XG1v4", 15), ("TG1682G", 12), ("CGM4140", 10), ("SR150", 8), ("RNG150", 5)]
+BOX_TYPES = {"DCX3200": "Set-top box", "DCX3510": "Set-top box", "XG1v4": "Set-top box", "TG1682G": "Modem",
+             "CGM4140": "Modem", "SR150": "Remote-Control", "RNG150": "Set-top box"}
+LOCATION_WEIGHTS = [50, 30, 20]
+# The common flow (scan, test, complete, pack, store, ship) dominates; failure paths are rare
+TEST_TYPE_WEIGHTS = {"SQT": 20, "SUMT": 15, "SSCAN": 12, "SCOMPLETE": 10, "SPACK": 8, "SSTORE": 6, "SSHIP": 6,
+                     "SPRO": 4, "SCL": 3, "SKIT": 3, "SDETSCAN": 3, "SPRETS": 2, "SPPOSTTS": 2, "SPOERUP": 2,
+                     "SCOSLAB": 1, "SCOSCLEAN": 1, "SFAILCOS": 1, "SFAILTEST": 1}
+TAX_RATE = 0.0725
+CHUNK_DEVICES = 20000
+
+# Data generation
+def generate(path, tests, customers=40, days=365, seed=7):
+    rng = random.Random(seed)
+    engine = create_app_engine(f"sqlite:///{path}")
+    session = sessionmaker(bind=engine)()
+    
+    today = datetime.now().date()
+    customer_names = [f"Customer {name}" for name in _unique_words(rng, customers)]
+    customer_weights = [1 / (rank + 1) for rank in range(customers)]
+    models, model_weights = zip(*MODELS)
+    test_types = list(TEST_TYPE_WEIGHTS)
+    test_weights = [TEST_TYPE_WEIGHTS[t] for t in test_types]
+    base_rates = {t: round(rng.uniform(2, 40), 2) for t in TEST_TYPES}
+    prefix = "".join(rng.choices(string.ascii_uppercase, k=3))
+    
+    batches = {}
+    written_tests = 0
+    serial_index = 0
+    started = time.perf_counter()
+    while written_tests < tests:
+        devices, device_tests = [], []
+        while len(devices) < CHUNK_DEVICES and written_tests + len(device_tests) < tests:
+            serial_index += 1
+            serial_number = f"{prefix}{serial_index:09d}"
+            model = rng.choices(models, model_weights)[0]
+            customer_name = rng.choices(customer_names, customer_weights)[0]
+            age = rng.randint(0, days)
+            report_date = today - timedelta(days=age)
+            
+            # Older devices are more likely to have moved on through batching and shipping
+            batch_number = ship_date = None
+            is_scrap = False
+            if rng.random() < min(0.95, age / 60):
+                key = (customer_name, report_date.isocalendar()[:2])
+                if key not in batches:
+                    batches[key] = generate_batch_number(serial_number, customer_name)
+                batch_number = batches[key]
+                if rng.random() < 0.7:
+                    ship_date = report_date + timedelta(days=rng.randint(0, age))
+            elif rng.random() < 0.02:
+                is_scrap = True
+            
+            devices.append({
+                "report_date": report_date,
+                "serial_number": serial_number,
+                "model": model,
+                "box_type": BOX_TYPES[model],
+                "customer_name": customer_name,
+                "location": rng.choices(TEST_LOCATIONS, LOCATION_WEIGHTS)[0],
+                "in_house": ship_date is None,
+                "is_scrap": is_scrap,
+                "service_code": None,
+                "storage_days_category": calculate_storage_days_category(report_date),
+                "batch_number": batch_number,
+                "ship_date": ship_date,
+            })
+            for test_type in rng.choices(test_types, test_weights, k=rng.randint(1, 7)):
+                rate = round(base_rates[test_type] * rng.uniform(0.9, 1.1), 2)
+                device_tests.append({
+                    "serial_number": serial_number,
+                    "model": model,
+                    "test_type": test_type,
+                    "test_date": report_date + timedelta(days=rng.randint(0, min(age, 30))),
+                    "test_location": devices[-1]["location"],
+                    "rate": rate,
+                    "tax": round(rate * TAX_RATE, 2),
+                    "spare_replacement": None,
+                    "notes": None,
+                    "is_completed": batch_number is not None,
+                    "batch_number": batch_number,
+                })
+        session.execute(Device.__table__.insert(), devices)
+        session.execute(Test.__table__.insert(), device_tests)
+        session.commit()
+        written_tests += len(device_tests)
+        print(f"  {serial_index:,} devices, {written_tests:,} tests ({time.perf_counter() - started:.1f}s)")
+    
+    conn = session.connection()
+    for index, ((customer_name, _), batch_number) in enumerate(batches.items(), start=1):
+        write_batch_ledger(conn, batch_number, customer_name)
+        if index % 1000 == 0:
+            session.commit()
+            conn = session.connection()
+    session.commit()
+    session.close()
+    print(f"{serial_index:,} devices, {written_tests:,} tests, {len(batches):,} batches in {path} "
+          f"({time.perf_counter() - started:.1f}s)")
+
+def _unique_words(rng, count):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choices(string.ascii_uppercase, k=1)) + "".join(rng.choices(string.ascii_lowercase, k=5)))
+    return sorted(words)
+
+# Page scenarios (mirror the data calls in main())
+def page_device_registration(session, snapshot_dir):
+    df, total, page = fetch_grid_page(session, Device, DEVICE_GRID_COLUMNS, {}, None, False, 1, 10)
+    format_grid_page(df)
+
+def page_add_new_test(session, snapshot_dir):
+    count_devices(session, "active")
+    devices = search_devices(session, "active", "")
+    search_devices(session, "active", devices[0].model[:2] if devices else "")
+
+def page_view_tests(session, snapshot_dir):
+    df, total, page = fetch_grid_page(session, Test, TEST_GRID_COLUMNS, {}, None, False, 1, 10)
+    format_grid_page(df)
+
+def page_create_batch(session, snapshot_dir):
+    count_devices(session, "pending_batch")
+    devices = search_devices(session, "pending_batch", "")
+    pending_test_summary(session, device_serials(session, "pending_batch", [d.id for d in devices]))
+
+def page_ship_devices(session, snapshot_dir):
+    count_devices(session, "pending_ship")
+    devices = search_devices(session, "pending_ship", "")
+    search_devices(session, "pending_ship", devices[0].customer_name[:3] if devices else "")
+
+def page_serial_history(session, snapshot_dir):
+    serial_number = session.query(Device.serial_number).order_by(Device.id.desc()).limit(1).scalar() or "X"
+    search_serials(session, serial_number[:-3], None, None, 50)
+    device_timeline(session, serial_number)
+
+def page_device_statistics(session, snapshot_dir):
+    snapshot = load_analytics_snapshot(snapshot_dir)
+    count_by(snapshot, "devices", 'Model', 'Model')
+    summary = device_summary_frame(session)
+    summary.groupby('Status', as_index=False)['Count'].sum()
+    summary.groupby(['Storage Age', 'Status'], as_index=False)['Count'].sum()
+    top_n(summary, 'Customer', 'Count')
+    top_n(summary, 'Location', 'Count')
+    device_days_in_system(snapshot)
+    device_report_frame(snapshot)
+
+def page_test_statistics(session, snapshot_dir):
+    snapshot = load_analytics_snapshot(snapshot_dir)
+    count_by(snapshot, "tests", 'Test Type', 'Test Type')
+    test_completion_counts(snapshot)
+    count_by(snapshot, "tests", 'Location', 'Location')
+    top_n(test_counts_by_model(snapshot), 'Model', 'Count', keys=['Test Type'])
+    average_rate_by_test_type(snapshot)
+    test_throughput(snapshot)
+    test_report_frame(snapshot)
+
+def page_financial_summary(session, snapshot_dir):
+    ledger_revenue_by(session, BatchLedgerLine.test_type, 'Test Type')
+    ledger_revenue_by(session, BatchLedgerLine.model, 'Model')
+    ledger_revenue_by(session, BatchLedger.customer_name, 'Customer')
+    snapshot = load_analytics_snapshot(snapshot_dir)
+    top_n(ledger_frame(session)[['Batch Number', 'Total']].astype({'Total': float}), 'Batch Number', 'Total')
+    rate_tax_density(snapshot)
+    revenue_over_time(snapshot)
+    ledger_totals(session)
+
+PAGES = {
+    "Device Registration": page_device_registration,
+    "Testing: Add New Test": page_add_new_test,
+    "Testing: View/Edit Tests": page_view_tests,
+    "Batch: Create Batch": page_create_batch,
+    "Batch: Ship Devices": page_ship_devices,
+    "Serial History": page_serial_history,
+    "Reports: Device Statistics": page_device_statistics,
+    "Reports: Test Statistics": page_test_statistics,
+    "Reports: Financial Summary": page_financial_summary,
+}
+
+# Benchmark harness
+def run(path, repeat=3):
+    engine = create_app_engine(f"sqlite:///{path}")
+    session = sessionmaker(bind=engine)()
+    cache = get_query_cache()
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(1))
+    
+    # Reports read a Parquet snapshot; build it once and time that separately
+    snapshot_dir = tempfile.mkdtemp(prefix="bench-snapshot-")
+    started = time.perf_counter()
+    build_analytics_snapshot(session, snapshot_dir)
+    snapshot_ms = (time.perf_counter() - started) * 1000
+    
+    results = {}
+    for name, page in PAGES.items():
+        cold, warm, sql = [], [], []
+        for _ in range(repeat):
+            cache.clear()
+            open_analytics_snapshot.clear()
+            session.expunge_all()
+            statements.clear()
+            started = time.perf_counter()
+            page(session, snapshot_dir)
+            cold.append(time.perf_counter() - started)
+            sql.append(len(statements))
+            started = time.perf_counter()
+            page(session, snapshot_dir)
+            warm.append(time.perf_counter() - started)
+        
+        cache.clear()
+        open_analytics_snapshot.clear()
+        tracemalloc.start()
+        page(session, snapshot_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        results[name] = {
+            "cold_ms": statistics.median(cold) * 1000,
+            "warm_ms": statistics.median(warm) * 1000,
+            "sql_statements": max(sql),
+            "peak_mb": peak / 2 ** 20,
+        }
+    session.close()
+    shutil.rmtree(snapshot_dir)
+    
+    size = sum(os.path.getsize(f) for f in (path, f"{path}-wal") if os.path.exists(f))
+    with engine.connect() as conn:
+        devices = conn.execute(select(func.count()).select_from(Device)).scalar()
+        tests = conn.execute(select(func.count()).select_from(Test)).scalar()
+    return {
+        "database": path,
+        "devices": devices,
+        "tests": tests,
+        "db_size_mb": size / 2 ** 20,
+        "snapshot_build_ms": snapshot_ms,
+        "pages": results,
+    }
+
+def report(result, baseline=None, threshold=1.25):
+    print(f"{result['database']}: {result['devices']:,} devices, {result['tests']:,} tests, {result['db_size_mb']:.1f} MB")
+    print(f"analytics snapshot build: {result['snapshot_build_ms']:,.0f} ms")
+    print(f"{'page':30} {'cold ms':>10} {'warm ms':>10} {'sql':>6} {'peak MB':>9}")
+    regressions = []
+    for name, page in result["pages"].items():
+        line = f"{name:30} {page['cold_ms']:10.1f} {page['warm_ms']:10.2f} {page['sql_statements']:6d} {page['peak_mb']:9.1f}"
+        old = (baseline or {}).get("pages", {}).get(name)
+        if old:
+            for metric in ("cold_ms", "peak_mb"):
+                if old[metric] and page[metric] > old[metric] * threshold:
+                    regressions.append(f"{name}: {metric} {old[metric]:.1f} -> {page[metric]:.1f}")
+            line += f"   (baseline cold {old['cold_ms']:.1f} ms, peak {old['peak_mb']:.1f} MB)"
+        print(line)
+    if baseline and result["db_size_mb"] > baseline["db_size_mb"] * threshold:
+        regressions.append(f"db size {baseline['db_size_mb']:.1f} -> {result['db_size_mb']:.1f} MB")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic data and benchmark each page's queries")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    gen = commands.add_parser("generate", help="fill a database with synthetic devices and tests")
+    gen.add_argument("path")
+    gen.add_argument("--tests", type=int, default=10000, help="approximate number of test rows")
+    gen.add_argument("--customers", type=int, default=40)
+    gen.add_argument("--days", type=int, default=365, help="spread of report dates")
+    gen.add_argument("--seed", type=int, default=7)
+    
+    bench = commands.add_parser("run", help="time every page against a database")
+    bench.add_argument("path")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--json", help="write results to this file")
+    bench.add_argument("--compare", help="baseline JSON from an earlier run")
+    bench.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+    
+    if args.command == "generate":
+        if os.path.exists(args.path):
+            parser.error(f"{args.path} already exists; generate into a fresh file")
+        generate(args.path, args.tests, args.customers, args.days, args.seed)
+        return 0
+    
+    result = run(args.path, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(result, baseline, args.threshold)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
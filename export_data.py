@@ -0,0 +1,35 @@
+# Export devices, tests or billing rows straight to a file without loading them into memory
+#
+#   python export_data.py billing billing_sept.xlsx --start 2026-09-01 --end 2026-09-30 --customer Acme
+#   python export_data.py tests tests.parquet --batch BATCH-20260901120000-...
+
+import argparse
+import sys
+from datetime import date
+from xdatabyte import session, write_export, EXPORT_DATASETS, EXPORT_CHUNK_SIZE
+
+FORMATS_BY_EXTENSION = {".csv": "CSV", ".xlsx": "XLSX", ".parquet": "Parquet"}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream an export from contec_tracks.db")
+    parser.add_argument("dataset", choices=[d.lower() for d in EXPORT_DATASETS])
+    parser.add_argument("path", help="output file; .csv, .xlsx or .parquet")
+    parser.add_argument("--start", type=date.fromisoformat, help="first report/test date, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="last report/test date, YYYY-MM-DD")
+    parser.add_argument("--customer")
+    parser.add_argument("--batch")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    
+    extension = args.path[args.path.rfind("."):].lower()
+    if extension not in FORMATS_BY_EXTENSION:
+        parser.error("output file must end in .csv, .xlsx or .parquet")
+    
+    with open(args.path, "wb") as out:
+        written = write_export(session, out, args.dataset.capitalize(), FORMATS_BY_EXTENSION[extension],
+                               args.start, args.end, args.customer, args.batch, args.chunk_size)
+    print(f"{written} rows written to {args.path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+# Feed test results from automated stations (SQT/SUMT/SSCAN...) straight into the tests table
+#
+#   python ingest_tests.py results.csv
+#   station-export | python ingest_tests.py --format jsonl -
+#
+# CSV columns / JSON keys: serial_number, test_type, test_date, test_location, rate, tax,
+# spare_replacement, notes, request_id (optional; a record whose request_id was already
+# ingested is skipped, so a station can resend a file after a timeout)
+
+import argparse
+import csv
+import json
+import sys
+from xdatabyte import session, ingest_tests, INGEST_BATCH_SIZE
+
+def read_records(stream, fmt):
+    if fmt == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for row in csv.DictReader(stream):
+            yield {key.strip().lower().replace(" ", "_"): value for key, value in row.items() if key}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load test results into contec_tracks.db")
+    parser.add_argument("path", help="CSV or JSON-lines file, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="defaults to the file extension, csv for stdin")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    
+    fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".json")) else "csv")
+    stream = sys.stdin if args.path == "-" else open(args.path, newline="")
+    try:
+        inserted, rejects = ingest_tests(session, read_records(stream, fmt), args.batch_size)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    
+    for reject in rejects:
+        print(f"record {reject['Record']} ({reject['Serial Number']}): {reject['Reason']}", file=sys.stderr)
+    print(f"{inserted} tests ingested, {len(rejects)} rejected")
+    failed = [reject for reject in rejects if reject["Reason"] != "already recorded"]
+    return 1 if failed and not inserted else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,25 @@
+# Work the background job queue outside Streamlit, e.g. with CONTEC_JOB_WORKERS=0 set for the app
+# so that batch, ship, import and snapshot jobs keep running while the web server restarts
+#
+#   python job_worker.py --workers 4
+
+import argparse
+import sys
+from xdatabyte import JobRunner, JOB_WORKERS
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run background jobs queued in contec_tracks.db")
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1))
+    args = parser.parse_args(argv)
+    
+    runner = JobRunner(args.workers).start()
+    print(f"{args.workers} workers waiting for jobs; Ctrl+C to stop")
+    try:
+        runner.wait()
+    except KeyboardInterrupt:
+        print("stopping after the current jobs")
+        runner.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
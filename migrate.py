@@ -0,0 +1,34 @@
+# Upgrade an existing contec_tracks.db in place and show the query plans before and after
+
+import sys
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from xdatabyte import upgrade_schema, query_plan_report
+
+def print_plans(session, title):
+    print(f"== {title} ==")
+    for name, (plan, full_scan) in query_plan_report(session).items():
+        print(f"{name}: {'FULL SCAN' if full_scan else 'ok'}")
+        for line in plan:
+            print(f"    {line}")
+
+def main(path):
+    engine = create_engine(f"sqlite:///{path}")
+    session = sessionmaker(bind=engine)()
+    print_plans(session, "before")
+    session.close()
+    
+    try:
+        applied = upgrade_schema(engine)
+    except RuntimeError as e:
+        print(f"upgrade failed: {e}", file=sys.stderr)
+        return 1
+    print(f"applied: {', '.join(applied) if applied else 'nothing, schema is current'}")
+    
+    session = sessionmaker(bind=engine)()
+    print_plans(session, "after")
+    session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else "contec_tracks.db"))
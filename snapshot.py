@@ -0,0 +1,31 @@
+# Rebuild the Parquet analytics snapshot that the Reports & Analytics page reads; run it from cron
+# to keep reports fresh without any browser session paying for the rebuild
+#
+#   python snapshot.py
+#   python snapshot.py --dir /srv/contec/analytics --if-changed
+
+import argparse
+import sys
+from xdatabyte import session, build_analytics_snapshot, read_snapshot_manifest, snapshot_build_lock, \
+    snapshot_watermark, SNAPSHOT_DIR, EXPORT_CHUNK_SIZE
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the analytics snapshot from contec_tracks.db")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument("--if-changed", action="store_true", help="skip the rebuild when no device or test was written")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    
+    # The lock is shared with the app's background snapshot job, so the two never build at once
+    with snapshot_build_lock(args.dir):
+        current = read_snapshot_manifest(args.dir)
+        if args.if_changed and current and current["watermark"] is not None \
+                and current["watermark"] == snapshot_watermark(session):
+            print(f"snapshot {current['version']} is current")
+            return 0
+        manifest = build_analytics_snapshot(session, args.dir, args.chunk_size)
+    print(f"snapshot {manifest['version']}: {manifest['rows']['devices']} devices, {manifest['rows']['tests']} tests")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import os
+import shutil
+import sqlite3
+import sys
+from datetime import date
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from xdatabyte import create_app_engine, get_query_cache, register_device, record_test
+
+@pytest.fixture
+def old_db(tmp_path):
+    # contec_test.db has the schema as it was before any migration
+    path = tmp_path / "old.db"
+    shutil.copy(os.path.join(ROOT, "contec_test.db"), path)
+    conn = sqlite3.connect(path)
+    yield path, conn
+    conn.close()
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_app_engine(f"sqlite:///{tmp_path / 'contec.db'}")
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session(engine):
+    # The query cache is process-wide and keyed by SQL, so results from another test's database must go
+    get_query_cache().clear()
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+@pytest.fixture
+def add_device(session):
+    def add(serial_number, customer_name="Acme", **fields):
+        device = dict(dict(report_date=date(2026, 9, 1), serial_number=serial_number, model="DCX3200",
+                           customer_name=customer_name, location="Charlotte"), **fields)
+        assert register_device(session, device)
+    return add
+
+@pytest.fixture
+def add_test(session):
+    def add(serial_number, rate, tax=0.0, test_type="SQT", **fields):
+        test = dict(serial_number=serial_number, model="DCX3200", test_type=test_type,
+                    test_date=date(2026, 9, 2), rate=rate, tax=tax, **fields)
+        assert record_test(session, test)
+    return add
@@ -0,0 +1,34 @@
+import sqlite3
+
+from sqlalchemy.orm import sessionmaker
+
+from xdatabyte import count_devices, get_run_profiler
+
+def test_write_from_another_process_invalidates_cached_counts(engine, session, add_device):
+    add_device("A1")
+    assert count_devices(session, "active") == 1
+    
+    # A plain sqlite3 connection stands in for a test station: no engine listener sees the commit
+    other = sqlite3.connect(engine.url.database)
+    other.execute("INSERT INTO devices (serial_number, model, customer_name, is_scrap) VALUES ('A2', 'DCX3200', 'Acme', 0)")
+    other.commit()
+    other.close()
+    
+    # The next page run gets a new session, which reads the new data version
+    rerun = sessionmaker(bind=engine)()
+    try:
+        assert count_devices(rerun, "active") == 2
+    finally:
+        rerun.close()
+
+def test_unchanged_data_is_served_from_cache(engine, session, add_device):
+    add_device("A1")
+    assert count_devices(session, "active") == 1
+    rerun = sessionmaker(bind=engine)()
+    profile = get_run_profiler().start()
+    try:
+        assert count_devices(rerun, "active") == 1
+        assert profile.cache_hits == 1
+    finally:
+        get_run_profiler().stop()
+        rerun.close()
@@ -0,0 +1,105 @@
+import csv
+import io
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import DatabaseError
+
+from xdatabyte import (BatchLedger, BatchLedgerLine, create_app_engine, create_batches, ledger_revenue_by,
+                       ledger_totals, batch_invoice, cents_to_decimal, count_devices, device_selection,
+                       pending_batch_preview, ship_devices, write_export)
+
+# PostgreSQL tests run only when a scratch database is given; they leave no rows behind
+POSTGRESQL_URL = os.getenv("CONTEC_TEST_POSTGRESQL_URL")
+
+@pytest.fixture
+def batches(session, add_device, add_test):
+    add_device("A1", "Acme")
+    add_device("A2", "Acme")
+    add_device("B1", "Bolt")
+    add_test("A1", 10.25, 0.75)
+    add_test("A1", 4.10, 0.30, test_type="SUMT")
+    add_test("A2", 10.25, 0.75)
+    add_test("B1", 99.99, 7.25)
+    return create_batches(session, ["A1", "A2", "B1"])
+
+def test_create_batches_writes_ledger_totals(session, batches):
+    assert sorted(len(serials) for serials in batches.values()) == [1, 2]
+    acme = next(number for number, serials in batches.items() if "A1" in serials)
+    header, lines = batch_invoice(session, acme)
+    
+    assert (header.customer_name, header.test_count) == ("Acme", 3)
+    assert (header.subtotal_cents, header.tax_cents, header.total_cents) == (2460, 180, 2640)
+    assert lines["Total"].sum() == Decimal("26.40")
+    assert ledger_totals(session)[0] == Decimal("26.40") + Decimal("107.24")
+
+def test_create_batches_never_bills_twice(session, batches):
+    assert create_batches(session, ["A1", "A2", "B1"]) == {}
+    assert session.query(BatchLedger).count() == 2
+
+def test_select_all_batches_and_ships_the_scope(session, add_device, add_test):
+    add_device("A1", "Acme")
+    add_device("A2", "Acme")
+    add_device("B1", None)
+    add_device("C1", "Acme")
+    add_test("A1", 10.25, 0.75)
+    add_test("A2", 10.25, 0.75)
+    add_test("B1", 99.99, 7.25)
+    
+    preview = pending_batch_preview(session, device_selection(session, "pending_batch")).set_index("Customer")
+    assert preview[["Devices", "Pending Tests"]].to_dict("index") == {"": {"Devices": 1, "Pending Tests": 1},
+                                                                      "Acme": {"Devices": 2, "Pending Tests": 2}}
+    batches = create_batches(session, device_selection(session, "pending_batch"))
+    assert sorted(sorted(serials) for serials in batches.values()) == [["A1", "A2"], ["B1"]]
+    assert ledger_totals(session)[0] == Decimal("22.00") + Decimal("107.24")
+    # C1 has no pending tests, so it stays unbatched
+    assert count_devices(session, "pending_batch") == 1
+    
+    assert ship_devices(session, device_selection(session, "pending_ship"), date(2026, 9, 30)) == 3
+
+def test_revenue_by_customer_joins_lines_to_their_batch(session, batches):
+    revenue = ledger_revenue_by(session, BatchLedger.customer_name, "Customer").set_index("Customer")["Total"]
+    assert revenue.to_dict() == {"Acme": 26.40, "Bolt": 107.24}
+    by_type = ledger_revenue_by(session, BatchLedgerLine.test_type, "Test Type").set_index("Test Type")["Total"]
+    assert by_type.to_dict() == {"SQT": 129.24, "SUMT": 4.40}
+
+def test_billing_export_adds_up_to_the_ledger(session, batches):
+    out = io.BytesIO()
+    write_export(session, out, "Billing", "CSV")
+    rows = list(csv.DictReader(io.StringIO(out.getvalue().decode())))
+    # Written as cents, never as float noise like 4.3999999999999995
+    assert sorted(row["Total"] for row in rows) == ["107.24", "11.0", "11.0", "4.4"]
+    assert sum(Decimal(row["Total"]) for row in rows) == ledger_totals(session)[0]
+
+def _assert_append_only(conn, batch_number):
+    for table in (BatchLedger, BatchLedgerLine):
+        for stmt in (update(table).values(test_count=0), delete(table)):
+            with pytest.raises(DatabaseError, match="append-only"):
+                with conn.begin_nested():
+                    conn.execute(stmt.where(table.batch_number == batch_number))
+
+def test_ledger_is_append_only(session, batches):
+    _assert_append_only(session.connection(), next(iter(batches)))
+    session.rollback()
+
+@pytest.mark.skipif(not POSTGRESQL_URL, reason="set CONTEC_TEST_POSTGRESQL_URL to run against PostgreSQL")
+def test_ledger_is_append_only_on_postgresql():
+    engine = create_app_engine(POSTGRESQL_URL)
+    try:
+        with engine.connect() as conn, conn.begin() as transaction:
+            conn.execute(insert(BatchLedger).values(batch_number="TEST-APPEND-ONLY", customer_name="Acme",
+                                                    created_at=datetime.now(), test_count=1, subtotal_cents=100,
+                                                    tax_cents=0, total_cents=100))
+            conn.execute(insert(BatchLedgerLine).values(batch_number="TEST-APPEND-ONLY", test_type="SQT",
+                                                        model="DCX3200", test_count=1, subtotal_cents=100, tax_cents=0))
+            _assert_append_only(conn, "TEST-APPEND-ONLY")
+            transaction.rollback()
+    finally:
+        engine.dispose()
+
+def test_cents_to_decimal_rounds_to_cents():
+    assert cents_to_decimal(None) == Decimal("0.00")
+    assert cents_to_decimal(12345) == Decimal("123.45")
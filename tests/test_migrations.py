@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from xdatabyte import DeviceSummaryMeta, MIGRATIONS, roll_forward_device_summary, upgrade_schema
+
+def _fill_old_schema(conn):
+    conn.executescript("""
+        INSERT INTO devices (serial_number, model, customer_name, location, is_scrap, report_date, batch_number, ship_date)
+        VALUES ('A1', 'DCX3200', 'Acme', 'Charlotte', 0, '2026-09-01', NULL, NULL),
+               ('A2', 'XG1v4', 'Acme', 'Sanjose', 0, '2026-09-01', 'BATCH-1', '2026-09-20');
+        INSERT INTO tests (serial_number, model, test_type, test_date, rate, tax, is_completed, batch_number)
+        VALUES ('A1', 'DCX3200', 'SQT', '2026-09-02', 10.0, 0.5, 0, NULL),
+               ('A2', 'XG1v4', 'SUMT', '2026-09-03', 20.0, 1.0, 1, 'BATCH-1');
+    """)
+    conn.commit()
+
+def test_upgrade_old_schema(old_db):
+    path, conn = old_db
+    _fill_old_schema(conn)
+    engine = create_engine(f"sqlite:///{path}")
+    
+    assert upgrade_schema(engine) == [name for name, _ in MIGRATIONS]
+    assert upgrade_schema(engine) == []
+    
+    assert any(fk["referred_table"] == "devices" for fk in inspect(engine).get_foreign_keys("tests"))
+    assert "request_id" in {c["name"] for c in inspect(engine).get_columns("tests")}
+    assert conn.execute("SELECT COUNT(*) FROM tests").fetchone() == (2,)
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+    # Backfills: the ledger row for the existing batch, the summary counts and the event history
+    assert conn.execute("SELECT test_count, total_cents FROM batch_ledger WHERE batch_number = 'BATCH-1'").fetchone() == (1, 2100)
+    assert conn.execute("SELECT SUM(device_count) FROM device_summary").fetchone() == (2,)
+    assert conn.execute("SELECT event_type FROM device_events WHERE serial_number = 'A2' ORDER BY id").fetchall() == \
+        [("registered",), ("tested",), ("batched",), ("shipped",)]
+    engine.dispose()
+
+def test_upgrade_refuses_orphaned_tests(old_db):
+    path, conn = old_db
+    _fill_old_schema(conn)
+    conn.execute("INSERT INTO tests (serial_number, test_type, rate, tax, is_completed) VALUES ('GHOST', 'SQT', 1, 0, 0)")
+    conn.commit()
+    engine = create_engine(f"sqlite:///{path}")
+    
+    with pytest.raises(RuntimeError, match="GHOST"):
+        upgrade_schema(engine)
+    # Nothing was rebuilt, so the orphan and every other row are still there
+    assert conn.execute("SELECT COUNT(*) FROM tests").fetchone() == (3,)
+    assert not any(fk["referred_table"] == "devices" for fk in inspect(engine).get_foreign_keys("tests"))
+    engine.dispose()
+
+def test_triggers_keep_summary_and_events_current(session, add_device, add_test):
+    add_device("S1")
+    add_device("S2")
+    add_test("S1", 10.0)
+    conn = session.connection()
+    
+    assert conn.exec_driver_sql("SELECT status, SUM(device_count) FROM device_summary GROUP BY status").all() == [("In Process", 2)]
+    assert conn.exec_driver_sql("SELECT event_type FROM device_events WHERE serial_number = 'S1' ORDER BY id").all() == \
+        [("registered",), ("tested",)]
+
+def test_roll_forward_moves_devices_into_older_buckets(session, add_device):
+    today = date.today()
+    add_device("S1", report_date=today - timedelta(days=35))
+    session.query(DeviceSummaryMeta).update({"as_of": today - timedelta(days=10)})
+    session.commit()
+    add_device("S2", report_date=today - timedelta(days=35))
+    conn = session.connection()
+    # Buckets are counted against as_of, 25 days after the report date
+    assert conn.exec_driver_sql("SELECT storage_bucket, device_count FROM device_summary").all() == \
+        [("30 to 45 days", 1), ("Less than 30 days", 1)]
+    
+    assert roll_forward_device_summary(session)
+    assert not roll_forward_device_summary(session)
+    conn = session.connection()
+    assert conn.exec_driver_sql("SELECT storage_bucket, device_count FROM device_summary").all() == [("30 to 45 days", 2)]
+    assert conn.exec_driver_sql("SELECT DISTINCT storage_days_category FROM devices").all() == [("30 to 45 days",)]
@@ -0,0 +1,15 @@
+import pandas as pd
+
+from xdatabyte import CHART_BINS, binned_counts
+
+def test_short_day_ranges_get_one_bin_per_day():
+    counts = binned_counts(pd.Series([0, 1, 2, 3, 4, 5, 6, 6]), "Days in System")
+    assert counts["Days in System"].tolist() == ["0", "1", "2", "3", "4", "5", "6"]
+    assert counts["Count"].tolist() == [1, 1, 1, 1, 1, 1, 2]
+
+def test_long_day_ranges_get_distinct_whole_day_bins():
+    counts = binned_counts(pd.Series(range(1000)), "Days in System")
+    assert len(counts) <= CHART_BINS
+    assert counts["Days in System"].is_unique
+    assert counts["Days in System"].iloc[0] == "0-33"
+    assert counts["Count"].sum() == 1000
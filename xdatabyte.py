@@ -8,11 +8,35 @@ from datetime import datetime, timedelta
 import time
 import random
 import string
-from sqlalchemy import create_engine, Column, String, Integer, Float, Date, DateTime, Boolean
+from sqlalchemy import create_engine, Column, String, Integer, Float, Date, DateTime, Boolean, ForeignKey, Index, func, case, cast, literal, select, insert, update, delete, inspect, exists, or_, and_, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+import os
+import io
+import csv
+import tempfile
+import shutil
 import uuid
+import hashlib
+from decimal import Decimal
+import threading
+import functools
+import itertools
+import contextlib
+from collections import OrderedDict
+import json
+import math
 import plotly.express as px
+from openpyxl import load_workbook, Workbook
+from dotenv import load_dotenv
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.schema import CreateIndex
 
 
 # Database setup
@@ -20,6 +44,11 @@ Base = declarative_base()
 
 class Device(Base):
     __tablename__ = 'devices'
+    __table_args__ = (
+        # "Create Batch" picks unbatched devices, "Ship Devices" picks batched but unshipped ones
+        Index('ix_devices_pending_batch', 'is_scrap', 'batch_number'),
+        Index('ix_devices_pending_ship', 'is_scrap', 'ship_date', 'batch_number'),
+    )
     id = Column(Integer, primary_key=True)
     report_date = Column(Date)
     serial_number = Column(String(50), unique=True, nullable=False)
@@ -33,11 +62,25 @@ class Device(Base):
     storage_days_category = Column(String(20))
     batch_number = Column(String(100))
     ship_date = Column(Date)
+
+# The device picker matches prefixes case-insensitively; every picker scope filters on is_scrap first
+DEVICE_SEARCH_INDEXES = (
+    Index('ix_devices_search_serial', Device.is_scrap, func.lower(Device.serial_number)),
+    Index('ix_devices_search_model', Device.is_scrap, func.lower(Device.model)),
+    Index('ix_devices_search_customer', Device.is_scrap, func.lower(Device.customer_name)),
+)
     
 class Test(Base):
     __tablename__ = 'tests'
+    __table_args__ = (
+        Index('ix_tests_serial_number_is_completed', 'serial_number', 'is_completed'),
+        Index('ix_tests_batch_number', 'batch_number'),
+        Index('ix_tests_is_completed_batch_number', 'is_completed', 'batch_number'),
+        # Idempotency key from the submitting form or station; NULLs never clash
+        Index('ix_tests_request_id', 'request_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
-    serial_number = Column(String(50))
+    serial_number = Column(String(50), ForeignKey('devices.serial_number'))
     model = Column(String(50))
     test_type = Column(String(50))
     test_date = Column(Date)
@@ -48,18 +91,827 @@ class Test(Base):
     notes = Column(String(500))
     is_completed = Column(Boolean, default=False)
     batch_number = Column(String(100))
+    request_id = Column(String(64))
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    name = Column(String(100), primary_key=True)
+    applied_at = Column(DateTime)
+
+class BatchLedger(Base):
+    # Written once when a batch is created; money is stored as integer cents
+    __tablename__ = 'batch_ledger'
+    batch_number = Column(String(100), primary_key=True)
+    customer_name = Column(String(100), index=True)
+    created_at = Column(DateTime, index=True)
+    test_count = Column(Integer, nullable=False)
+    subtotal_cents = Column(Integer, nullable=False)
+    tax_cents = Column(Integer, nullable=False)
+    total_cents = Column(Integer, nullable=False)
+
+class BatchLedgerLine(Base):
+    __tablename__ = 'batch_ledger_lines'
+    batch_number = Column(String(100), ForeignKey('batch_ledger.batch_number'), primary_key=True)
+    test_type = Column(String(50), primary_key=True)
+    model = Column(String(50), primary_key=True)
+    test_count = Column(Integer, nullable=False)
+    subtotal_cents = Column(Integer, nullable=False)
+    tax_cents = Column(Integer, nullable=False)
+
+class DeviceEvent(Base):
+    # Append-only lifecycle log; no foreign key so history outlives archived devices
+    __tablename__ = 'device_events'
+    __table_args__ = (
+        Index('ix_device_events_serial_time', 'serial_number', 'event_time'),
+    )
+    id = Column(Integer, primary_key=True)
+    serial_number = Column(String(50), nullable=False)
+    event_type = Column(String(20), nullable=False)
+    event_time = Column(DateTime, nullable=False)
+    detail = Column(String(200))
+    reference = Column(String(100))
+
+class DeviceSummary(Base):
+    __tablename__ = 'device_summary'
+    storage_bucket = Column(String(20), primary_key=True)
+    status = Column(String(20), primary_key=True)
+    customer_name = Column(String(100), primary_key=True)
+    location = Column(String(50), primary_key=True)
+    device_count = Column(Integer, nullable=False, default=0)
+
+class DeviceSummaryMeta(Base):
+    __tablename__ = 'device_summary_meta'
+    id = Column(Integer, primary_key=True)
+    as_of = Column(Date)
+
+class Job(Base):
+    # Background work queue; see the background jobs section
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    idempotency_key = Column(String(100), unique=True, nullable=False)
+    params = Column(String, nullable=False)
+    status = Column(String(20), nullable=False)
+    progress = Column(Float, nullable=False, default=0.0)
+    message = Column(String(200))
+    result = Column(String)
+    error = Column(String(500))
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    worker = Column(String(100))
+    created_at = Column(DateTime, nullable=False)
+    run_after = Column(DateTime, nullable=False)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+class DeviceArchive(Base):
+    # Shipped and scrapped devices moved out of devices by archive_devices. A serial number can be
+    # registered again after archiving, so archived_at is what ties a device to its archived tests.
+    __tablename__ = 'devices_archive'
+    __table_args__ = (
+        Index('ix_devices_archive_serial_number', 'serial_number', 'archived_at'),
+    )
+    archive_id = Column(Integer, primary_key=True)
+    id = Column(Integer)
+    report_date = Column(Date)
+    serial_number = Column(String(50), nullable=False)
+    model = Column(String(50))
+    box_type = Column(String(50))
+    customer_name = Column(String(100))
+    location = Column(String(50))
+    in_house = Column(Boolean)
+    is_scrap = Column(Boolean)
+    service_code = Column(String(50))
+    storage_days_category = Column(String(20))
+    batch_number = Column(String(100))
+    ship_date = Column(Date)
+    archived_at = Column(DateTime, nullable=False)
+
+class TestArchive(Base):
+    __tablename__ = 'tests_archive'
+    __table_args__ = (
+        Index('ix_tests_archive_serial_number', 'serial_number', 'archived_at'),
+        Index('ix_tests_archive_batch_number', 'batch_number'),
+    )
+    archive_id = Column(Integer, primary_key=True)
+    id = Column(Integer)
+    serial_number = Column(String(50))
+    model = Column(String(50))
+    test_type = Column(String(50))
+    test_date = Column(Date)
+    test_location = Column(String(50))
+    rate = Column(Float)
+    tax = Column(Float)
+    spare_replacement = Column(String(200))
+    notes = Column(String(500))
+    is_completed = Column(Boolean)
+    batch_number = Column(String(100))
+    request_id = Column(String(64))
+    archived_at = Column(DateTime, nullable=False)
+
+# Device aging summary (triggers keep device_summary current on every write to devices, on SQLite since
+# migration 0003 and PostgreSQL since 0009; buckets are relative to device_summary_meta.as_of, which
+# roll_forward_device_summary moves daily)
+_JULIAN_DAYS = "julianday({}) - julianday({})".format
+_PG_DAYS = "(CAST({} AS DATE) - {})".format
+
+def _storage_bucket_sql(row, as_of, days=_JULIAN_DAYS):
+    days = days(as_of, f"{row}.report_date")
+    return (f"CASE WHEN {row}.report_date IS NULL THEN 'Unknown' "
+            f"WHEN {days} < 30 THEN 'Less than 30 days' "
+            f"WHEN {days} < 45 THEN '30 to 45 days' "
+            f"WHEN {days} <= 90 THEN '45 to 90 days' "
+            f"ELSE 'Over 90 days' END")
+
+def _device_status_sql(row):
+    return (f"CASE WHEN {row}.is_scrap THEN 'Scrap' "
+            f"WHEN {row}.ship_date IS NOT NULL THEN 'Shipped' "
+            f"WHEN {row}.batch_number IS NOT NULL THEN 'Batched' "
+            f"ELSE 'In Process' END")
+
+_SUMMARY_AS_OF = "(SELECT as_of FROM device_summary_meta WHERE id = 1)"
+
+def _summary_delta_sql(row, delta, days=_JULIAN_DAYS):
+    return (
+        "INSERT INTO device_summary (storage_bucket, status, customer_name, location, device_count) "
+        f"VALUES ({_storage_bucket_sql(row, _SUMMARY_AS_OF, days)}, {_device_status_sql(row)}, "
+        f"COALESCE({row}.customer_name, ''), COALESCE({row}.location, ''), {delta}) "
+        "ON CONFLICT (storage_bucket, status, customer_name, location) "
+        "DO UPDATE SET device_count = device_summary.device_count + excluded.device_count;"
+    )
+
+DEVICE_SUMMARY_TRIGGERS = {
+    "trg_device_summary_insert":
+        "AFTER INSERT ON devices BEGIN "
+        + _summary_delta_sql("NEW", 1) + " END",
+    "trg_device_summary_update":
+        "AFTER UPDATE OF report_date, is_scrap, ship_date, batch_number, customer_name, location ON devices BEGIN "
+        + _summary_delta_sql("OLD", -1) + " " + _summary_delta_sql("NEW", 1)
+        + " DELETE FROM device_summary WHERE device_count = 0; END",
+    "trg_device_summary_delete":
+        "AFTER DELETE ON devices BEGIN "
+        + _summary_delta_sql("OLD", -1)
+        + " DELETE FROM device_summary WHERE device_count = 0; END",
+}
+
+# PostgreSQL: one row-level trigger function covering insert, update and delete (migration 0009)
+POSTGRESQL_DEVICE_SUMMARY_FUNCTIONS = {
+    "trg_device_summary_devices": (
+        "AFTER INSERT OR DELETE OR UPDATE OF report_date, is_scrap, ship_date, batch_number, customer_name, location ON devices",
+        "IF TG_OP <> 'INSERT' THEN " + _summary_delta_sql("OLD", -1, _PG_DAYS) + " END IF; "
+        "IF TG_OP <> 'DELETE' THEN " + _summary_delta_sql("NEW", 1, _PG_DAYS) + " END IF; "
+        "IF TG_OP <> 'INSERT' THEN DELETE FROM device_summary WHERE device_count = 0; END IF; RETURN NULL;"
+    ),
+}
+
+def rebuild_device_summary(conn, as_of):
+    # Full recount in one GROUP BY; also refreshes the stale per-device storage_days_category
+    if conn.dialect.name == 'postgresql':
+        bucket, differs = _storage_bucket_sql('devices', ':as_of', _PG_DAYS), "IS DISTINCT FROM"
+    else:
+        bucket, differs = _storage_bucket_sql('devices', ':as_of'), "IS NOT"
+    conn.execute(DeviceSummary.__table__.delete())
+    conn.execute(text(
+        "INSERT INTO device_summary (storage_bucket, status, customer_name, location, device_count) "
+        f"SELECT {bucket}, {_device_status_sql('devices')}, "
+        "COALESCE(customer_name, ''), COALESCE(location, ''), COUNT(*) FROM devices GROUP BY 1, 2, 3, 4"
+    ), {"as_of": as_of.isoformat()})
+    conn.execute(text(
+        f"UPDATE devices SET storage_days_category = {bucket} "
+        f"WHERE report_date IS NOT NULL AND storage_days_category {differs} {bucket}"
+    ), {"as_of": as_of.isoformat()})
+
+def roll_forward_device_summary(session):
+    # Cheap when already current: one primary-key read. The conditional UPDATE lets only
+    # one of several concurrent callers do the rebuild.
+    today = datetime.now().date()
+    as_of = session.scalar(select(DeviceSummaryMeta.as_of).where(DeviceSummaryMeta.id == 1))
+    if as_of is not None and as_of >= today:
+        return False
+    moved = session.execute(
+        update(DeviceSummaryMeta)
+        .where(DeviceSummaryMeta.id == 1, DeviceSummaryMeta.as_of < today)
+        .values(as_of=today)
+    ).rowcount
+    if moved:
+        rebuild_device_summary(session.connection(), today)
+    session.commit()
+    return bool(moved)
+
+# Billing ledger (one immutable row per batch plus one line per test type and model)
+LEDGER_TRIGGERS = {
+    f"trg_{table}_{action.lower()}_forbidden": f"BEFORE {action} ON {table} BEGIN SELECT RAISE(ABORT, '{table} is append-only'); END"
+    for table in ("batch_ledger", "batch_ledger_lines")
+    for action in ("UPDATE", "DELETE")
+}
+
+# PostgreSQL: the same guard as one BEFORE UPDATE OR DELETE function per table (migration 0010)
+POSTGRESQL_LEDGER_FUNCTIONS = {
+    f"trg_{table}_append_only": (f"BEFORE UPDATE OR DELETE ON {table}", f"RAISE EXCEPTION '{table} is append-only';")
+    for table in ("batch_ledger", "batch_ledger_lines")
+}
+
+def cents_to_decimal(cents):
+    return (Decimal(int(cents or 0)) / 100).quantize(Decimal("0.01"))
+
+def _test_cents(column):
+    # One test's amount in whole cents; the ledger and the billing export round the same way
+    return cast(func.round(func.coalesce(column, 0) * 100), Integer)
+
+def _cents(column):
+    return func.sum(_test_cents(column))
+
+def write_batch_ledger(conn, batch_number, customer_name):
+    # Runs inside the caller's transaction, after the batch's tests have been marked completed
+    test_type = func.coalesce(Test.test_type, "")
+    model = func.coalesce(Test.model, "")
+    lines = conn.execute(
+        select(test_type.label("test_type"), model.label("model"), func.count().label("test_count"),
+               _cents(Test.rate).label("subtotal_cents"), _cents(Test.tax).label("tax_cents"))
+        .where(Test.batch_number == batch_number, Test.is_completed == True)
+        .group_by(test_type, model)
+    ).mappings().all()
+    subtotal = sum(line["subtotal_cents"] for line in lines)
+    tax = sum(line["tax_cents"] for line in lines)
+    conn.execute(insert(BatchLedger).values(
+        batch_number=batch_number,
+        customer_name=customer_name,
+        created_at=datetime.now(),
+        test_count=sum(line["test_count"] for line in lines),
+        subtotal_cents=subtotal,
+        tax_cents=tax,
+        total_cents=subtotal + tax
+    ))
+    if lines:
+        conn.execute(insert(BatchLedgerLine), [dict(line, batch_number=batch_number) for line in lines])
+
+# Device lifecycle events (SQLite triggers append one row per registration, test, batch, shipment and scrap)
+_EVENT_NOW = "datetime('now', 'localtime')"
+
+def _event_insert_sql(serial, event_type, detail, reference="NULL", now=_EVENT_NOW):
+    return ("INSERT INTO device_events (serial_number, event_type, event_time, detail, reference) "
+            f"VALUES ({serial}, '{event_type}', {now}, {detail}, {reference});")
+
+DEVICE_EVENT_TRIGGERS = {
+    "trg_device_events_registered":
+        "AFTER INSERT ON devices BEGIN "
+        + _event_insert_sql("NEW.serial_number", "registered",
+                            "'Model ' || COALESCE(NEW.model, '') || ', ' || COALESCE(NEW.customer_name, '') || ', ' || COALESCE(NEW.location, '')")
+        + " END",
+    "trg_device_events_tested":
+        "AFTER INSERT ON tests BEGIN "
+        + _event_insert_sql("NEW.serial_number", "tested",
+                            "COALESCE(NEW.test_type, '') || ' at ' || COALESCE(NEW.test_location, '')",
+                            "CAST(NEW.id AS TEXT)")
+        + " END",
+    "trg_device_events_batched":
+        "AFTER UPDATE OF batch_number ON devices WHEN OLD.batch_number IS NULL AND NEW.batch_number IS NOT NULL BEGIN "
+        + _event_insert_sql("NEW.serial_number", "batched", "'Batch ' || NEW.batch_number", "NEW.batch_number")
+        + " END",
+    "trg_device_events_shipped":
+        "AFTER UPDATE OF ship_date ON devices WHEN OLD.ship_date IS NULL AND NEW.ship_date IS NOT NULL BEGIN "
+        + _event_insert_sql("NEW.serial_number", "shipped", "'Shipped ' || NEW.ship_date", "NEW.batch_number")
+        + " END",
+    "trg_device_events_scrapped":
+        "AFTER UPDATE OF is_scrap ON devices WHEN NOT COALESCE(OLD.is_scrap, 0) AND NEW.is_scrap BEGIN "
+        + _event_insert_sql("NEW.serial_number", "scrapped", "'Scrapped'")
+        + " END",
+}
+
+# PostgreSQL gets the same events from one row-level trigger function per table (migration 0008)
+_PG_EVENT_NOW = "LOCALTIMESTAMP"
+
+POSTGRESQL_DEVICE_EVENT_FUNCTIONS = {
+    "trg_device_events_devices": (
+        "AFTER INSERT OR UPDATE ON devices",
+        "IF TG_OP = 'INSERT' THEN "
+        + _event_insert_sql("NEW.serial_number", "registered",
+                            "'Model ' || COALESCE(NEW.model, '') || ', ' || COALESCE(NEW.customer_name, '') || ', ' || COALESCE(NEW.location, '')", now=_PG_EVENT_NOW)
+        + " RETURN NULL; END IF; "
+        "IF OLD.batch_number IS NULL AND NEW.batch_number IS NOT NULL THEN "
+        + _event_insert_sql("NEW.serial_number", "batched", "'Batch ' || NEW.batch_number", "NEW.batch_number", now=_PG_EVENT_NOW)
+        + " END IF; "
+        "IF OLD.ship_date IS NULL AND NEW.ship_date IS NOT NULL THEN "
+        + _event_insert_sql("NEW.serial_number", "shipped", "'Shipped ' || NEW.ship_date", "NEW.batch_number", now=_PG_EVENT_NOW)
+        + " END IF; "
+        "IF NOT COALESCE(OLD.is_scrap, FALSE) AND NEW.is_scrap THEN "
+        + _event_insert_sql("NEW.serial_number", "scrapped", "'Scrapped'", now=_PG_EVENT_NOW)
+        + " END IF; RETURN NULL;"
+    ),
+    "trg_device_events_tests": (
+        "AFTER INSERT ON tests",
+        _event_insert_sql("NEW.serial_number", "tested",
+                          "COALESCE(NEW.test_type, '') || ' at ' || COALESCE(NEW.test_location, '')",
+                          "CAST(NEW.id AS TEXT)", now=_PG_EVENT_NOW)
+        + " RETURN NULL;"
+    ),
+}
+
+def _backfill_device_events(conn):
+    # History before the log existed, reconstructed from the dates the rows carry
+    if conn.dialect.name == 'postgresql':
+        timestamp, now, earliest = "CAST({} AS TIMESTAMP)".format, "LOCALTIMESTAMP", "LEAST"
+    else:
+        timestamp, now, earliest = "datetime({})".format, "datetime('now')", "MIN"
+    conn.exec_driver_sql(
+        "INSERT INTO device_events (serial_number, event_type, event_time, detail) "
+        f"SELECT serial_number, 'registered', COALESCE({timestamp('report_date')}, {now}), "
+        "'Model ' || COALESCE(model, '') || ', ' || COALESCE(customer_name, '') || ', ' || COALESCE(location, '') "
+        "FROM devices"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO device_events (serial_number, event_type, event_time, detail, reference) "
+        f"SELECT serial_number, 'tested', COALESCE({timestamp('test_date')}, {now}), "
+        "COALESCE(test_type, '') || ' at ' || COALESCE(test_location, ''), CAST(id AS TEXT) "
+        "FROM tests WHERE serial_number IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO device_events (serial_number, event_type, event_time, detail, reference) "
+        f"SELECT d.serial_number, 'batched', {earliest}(COALESCE(l.created_at, {now}), COALESCE({timestamp('d.ship_date')}, {now})), "
+        "'Batch ' || d.batch_number, d.batch_number "
+        "FROM devices d LEFT JOIN batch_ledger l ON l.batch_number = d.batch_number WHERE d.batch_number IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO device_events (serial_number, event_type, event_time, detail, reference) "
+        f"SELECT serial_number, 'shipped', {timestamp('ship_date')}, 'Shipped ' || ship_date, batch_number "
+        "FROM devices WHERE ship_date IS NOT NULL"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO device_events (serial_number, event_type, event_time, detail) "
+        f"SELECT serial_number, 'scrapped', {now}, 'Scrapped' FROM devices WHERE is_scrap"
+    )
+
+def device_timeline(session, serial_number):
+    # One index range scan on (serial_number, event_time)
+    rows = (session.query(DeviceEvent.event_time, DeviceEvent.event_type, DeviceEvent.detail, DeviceEvent.reference)
+            .filter(DeviceEvent.serial_number == serial_number)
+            .order_by(DeviceEvent.event_time, DeviceEvent.id)
+            .all())
+    return pd.DataFrame(rows, columns=["Time", "Event", "Detail", "Reference"])
+
+def _prefix_upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def search_serials(session, prefix=None, start=None, end=None, limit=20):
+    # Prefix or [start, end] range over serials that have history, as index range scans
+    query = session.query(DeviceEvent.serial_number).distinct()
+    if prefix:
+        query = query.filter(DeviceEvent.serial_number >= prefix,
+                             DeviceEvent.serial_number < _prefix_upper_bound(prefix))
+    if start:
+        query = query.filter(DeviceEvent.serial_number >= start)
+    if end:
+        query = query.filter(DeviceEvent.serial_number <= end)
+    return [serial for (serial,) in query.order_by(DeviceEvent.serial_number).limit(limit)]
+
+# Schema migrations (each step is idempotent and recorded, so existing databases upgrade in place)
+def _add_tests_device_fk(conn):
+    if any(fk['referred_table'] == 'devices' for fk in inspect(conn).get_foreign_keys('tests')):
+        return
+    if conn.dialect.name != 'sqlite':
+        conn.exec_driver_sql(
+            "ALTER TABLE tests ADD CONSTRAINT fk_tests_serial_number "
+            "FOREIGN KEY (serial_number) REFERENCES devices (serial_number)"
+        )
+        return
+    # SQLite cannot add a constraint to an existing table, so rebuild it and copy the rows over.
+    # Orphaned tests would be copied in violating the new key, so refuse before touching anything.
+    orphans = conn.exec_driver_sql(
+        "SELECT DISTINCT serial_number FROM tests WHERE serial_number IS NOT NULL "
+        "AND serial_number NOT IN (SELECT serial_number FROM devices)"
+    ).scalars().all()
+    if orphans:
+        raise RuntimeError(f"{len(orphans)} serial numbers in tests are not registered devices "
+                           f"(e.g. {', '.join(orphans[:5])}); register or remove them, then upgrade again")
+    old_columns = {c['name'] for c in inspect(conn).get_columns('tests')}
+    columns = ", ".join(c.name for c in Test.__table__.columns if c.name in old_columns)
+    for index in inspect(conn).get_indexes('tests'):
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index['name']}")
+    conn.exec_driver_sql("ALTER TABLE tests RENAME TO tests_old")
+    Test.__table__.create(conn)
+    conn.exec_driver_sql(f"INSERT INTO tests ({columns}) SELECT {columns} FROM tests_old")
+    conn.exec_driver_sql("DROP TABLE tests_old")
+    violations = conn.exec_driver_sql("PRAGMA foreign_key_check(tests)").all()
+    if violations:
+        raise RuntimeError(f"tests rebuild left {len(violations)} foreign key violations")
+
+def _add_lookup_indexes(conn):
+    # IF NOT EXISTS rather than checkfirst, which cannot reflect expression indexes.
+    # Indexes on columns a later migration adds are left to that migration.
+    for table in (Device.__table__, Test.__table__):
+        existing = {c['name'] for c in inspect(conn).get_columns(table.name)}
+        for index in table.indexes:
+            if all(column.name in existing for column in index.columns):
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+def _add_tests_request_id(conn):
+    if 'request_id' not in {c['name'] for c in inspect(conn).get_columns('tests')}:
+        conn.exec_driver_sql("ALTER TABLE tests ADD COLUMN request_id VARCHAR(64)")
+    _add_lookup_indexes(conn)
+
+def _add_device_summary(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    for name, body in DEVICE_SUMMARY_TRIGGERS.items():
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+        conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+    today = datetime.now().date()
+    conn.execute(DeviceSummaryMeta.__table__.delete())
+    conn.execute(insert(DeviceSummaryMeta).values(id=1, as_of=today))
+    rebuild_device_summary(conn, today)
+
+def _add_batch_ledger(conn):
+    # Backfill batches created before the ledger existed, then lock the tables
+    batches = conn.execute(
+        select(Test.batch_number, func.max(Device.customer_name))
+        .select_from(Test)
+        .outerjoin(Device, Device.serial_number == Test.serial_number)
+        .where(Test.batch_number != None, Test.is_completed == True,
+               Test.batch_number.not_in(select(BatchLedger.batch_number)))
+        .group_by(Test.batch_number)
+    ).all()
+    for batch_number, customer_name in batches:
+        write_batch_ledger(conn, batch_number, customer_name or "")
+    if conn.dialect.name == 'sqlite':
+        for name, body in LEDGER_TRIGGERS.items():
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+            conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+
+def _add_device_events(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    conn.execute(DeviceEvent.__table__.delete())
+    _backfill_device_events(conn)
+    for name, body in DEVICE_EVENT_TRIGGERS.items():
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+        conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+
+def _create_postgresql_triggers(conn, functions):
+    # {name: (timing, plpgsql body)}; each trigger runs the function of the same name once per row
+    for name, (timing, body) in functions.items():
+        conn.exec_driver_sql(f"CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$ BEGIN {body} END; $$ LANGUAGE plpgsql")
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name} ON {timing.split()[-1]}")
+        conn.exec_driver_sql(f"CREATE TRIGGER {name} {timing} FOR EACH ROW EXECUTE FUNCTION {name}()")
+
+def _add_postgresql_device_events(conn):
+    # 0005 only covered SQLite; rows already logged (archived devices) are kept
+    if conn.dialect.name != 'postgresql':
+        return
+    _backfill_device_events(conn)
+    _create_postgresql_triggers(conn, POSTGRESQL_DEVICE_EVENT_FUNCTIONS)
+
+def _add_postgresql_ledger_triggers(conn):
+    # 0004 only locked the ledger on SQLite
+    if conn.dialect.name != 'postgresql':
+        return
+    _create_postgresql_triggers(conn, POSTGRESQL_LEDGER_FUNCTIONS)
+
+def _add_postgresql_device_summary(conn):
+    # 0003 only covered SQLite
+    if conn.dialect.name != 'postgresql':
+        return
+    _create_postgresql_triggers(conn, POSTGRESQL_DEVICE_SUMMARY_FUNCTIONS)
+    today = datetime.now().date()
+    conn.execute(DeviceSummaryMeta.__table__.delete())
+    conn.execute(insert(DeviceSummaryMeta).values(id=1, as_of=today))
+    rebuild_device_summary(conn, today)
+
+MIGRATIONS = [
+    ("0001_tests_device_fk", _add_tests_device_fk),
+    ("0002_lookup_indexes", _add_lookup_indexes),
+    ("0003_device_summary", _add_device_summary),
+    ("0004_batch_ledger", _add_batch_ledger),
+    ("0005_device_events", _add_device_events),
+    ("0006_device_search_indexes", _add_lookup_indexes),
+    ("0007_tests_request_id", _add_tests_request_id),
+    ("0008_postgresql_device_events", _add_postgresql_device_events),
+    ("0009_postgresql_device_summary", _add_postgresql_device_summary),
+    ("0010_postgresql_ledger_triggers", _add_postgresql_ledger_triggers),
+]
+
+def upgrade_schema(engine):
+    Base.metadata.create_all(engine)
+    applied = []
+    with engine.connect() as conn:
+        done = set(conn.execute(select(SchemaMigration.name)).scalars())
+        conn.commit()
+        pending = [(name, migrate) for name, migrate in MIGRATIONS if name not in done]
+        if not pending:
+            return applied
+        # Table rebuilds must not trip foreign key checks; the pragma is a no-op inside a transaction
+        sqlite = conn.dialect.name == 'sqlite'
+        if sqlite:
+            conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            conn.commit()
+        for name, migrate in pending:
+            with conn.begin():
+                migrate(conn)
+                conn.execute(insert(SchemaMigration).values(name=name, applied_at=datetime.now()))
+            applied.append(name)
+        if sqlite:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+            conn.commit()
+    return applied
+
+# Query cache (shared across reruns and browser sessions; committed writes invalidate by table)
+class QueryCache:
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, version=None):
+        # An entry is dropped once the data version of any table it read has moved on
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or entry[0] < time.monotonic()
+                    or any(version is None or version[part] != value for part, value in entry[3].items())):
+                self._entries.pop(key, None)
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[2]
     
-# Initialize database
-engine = create_engine('sqlite:///contec_tracks.db')
-#engine = create_engine('bsqlite:///contec_tracks.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+    def put(self, key, tables, value, version=None):
+        with self._lock:
+            stamp = {part: version[part] for table in tables for part in DATA_VERSION_PARTS.get(table, ())} if version else {}
+            self._entries[key] = (time.monotonic() + self.ttl, frozenset(tables), value, stamp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, tables):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[1] & set(tables)]:
+                del self._entries[key]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def get_query_cache():
+    return QueryCache()
+
+# Writes from other processes (test stations, job_worker.py, archive.py) never reach this process's
+# invalidation, so entries are also checked against a data version read at most once a second per session.
+# Every device and test write appends to device_events (batching also writes the ledger, archiving logs an
+# event), and the daily roll-forward rewrites storage_days_category under a new as_of.
+DATA_VERSION_RECHECK_SECONDS = 1.0
+DATA_VERSION_PARTS = {
+    "devices": ("events", "as_of"),
+    "tests": ("events",),
+    "devices_archive": ("events",),
+    "tests_archive": ("events",),
+    "batch_ledger": ("events",),
+    "batch_ledger_lines": ("events",),
+    "device_events": ("events",),
+}
+
+def data_version(session):
+    checked_at, version = session.info.get("data_version", (None, None))
+    if checked_at is None or time.monotonic() - checked_at > DATA_VERSION_RECHECK_SECONDS:
+        events, as_of = session.execute(select(
+            select(func.max(DeviceEvent.id)).scalar_subquery(),
+            select(DeviceSummaryMeta.as_of).where(DeviceSummaryMeta.id == 1).scalar_subquery()
+        )).one()
+        version = {"events": events, "as_of": as_of}
+        session.info["data_version"] = (time.monotonic(), version)
+    return version
+
+def _track_tables(conn, clauseelement, multiparams, params, execution_options, result):
+    if isinstance(clauseelement, UpdateBase):
+        conn.info.setdefault("tables_written", set()).add(clauseelement.table.name)
+    elif "tables_read" in conn.info and isinstance(clauseelement, ClauseElement):
+        tables = find_tables(clauseelement, check_columns=True)
+        conn.info["tables_read"].update(t.name for t in tables if getattr(t, "name", None))
+
+def _invalidate_written_tables(conn):
+    tables = conn.info.pop("tables_written", None)
+    if tables:
+        get_query_cache().invalidate(tables)
+
+def _discard_written_tables(conn):
+    conn.info.pop("tables_written", None)
+
+def _cache_key(value):
+    # Models and expressions are rebuilt on every rerun, so key them by what they render to
+    if hasattr(value, "__tablename__"):
+        return value.__tablename__
+    if isinstance(value, ClauseElement):
+        return (getattr(value, "key", None), str(value.compile(compile_kwargs={"literal_binds": True})))
+    if isinstance(value, (list, tuple)):
+        return tuple(_cache_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _cache_key(v)) for k, v in value.items())
+    return value
+
+def cached_query(fn):
+    # Caches fn(session, *args) by its arguments and tags the entry with every table it read.
+    # Cached results are shared, so callers must treat them as read-only.
+    @functools.wraps(fn)
+    def wrapper(session, *args):
+        cache = get_query_cache()
+        key = (fn.__name__, _cache_key(args))
+        # Read before fn runs, so an entry is never stamped newer than the data it holds
+        version = data_version(session)
+        hit, value = cache.get(key, version)
+        if hit:
+            profile = get_run_profiler().current
+            if profile is not None:
+                profile.cache_hits += 1
+            return value
+        # The engine listener is registered once per engine, so the read set lives on the connection
+        info = session.connection().info
+        outer = info.get("tables_read")
+        info["tables_read"] = tables = set()
+        try:
+            value = fn(session, *args)
+        finally:
+            if outer is None:
+                info.pop("tables_read", None)
+            else:
+                outer.update(tables)
+                info["tables_read"] = outer
+        cache.put(key, tables, value, version)
+        return value
+    return wrapper
+
+# Run profiling (per-rerun SQL count and timings, split by section of main(); see the admin panel)
+PROFILE_PANEL = os.getenv("CONTEC_ADMIN_PANEL", "0") == "1"
+PROFILE_LOG = os.getenv("CONTEC_PROFILE_LOG")
+PROFILE_HISTORY_SIZE = 50
+# The same statement this many times in one section is almost always a per-row lookup
+REPEATED_SQL_THRESHOLD = 5
+
+class RunProfile:
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.page = None
+        self.sections = []
+        self.statements = []
+        self.cache_hits = 0
+        self._section = "Startup"
+        self._section_start = time.perf_counter()
+    
+    def section(self, name):
+        now = time.perf_counter()
+        self.sections.append((self._section, now - self._section_start))
+        self._section, self._section_start = name, now
+    
+    def record_sql(self, statement, seconds):
+        self.statements.append((self._section, " ".join(statement.split()), seconds))
+    
+    def finish(self):
+        self.section(None)
+    
+    def section_frame(self):
+        sections = pd.DataFrame(self.sections, columns=['Section', 'Seconds'])
+        sql = pd.DataFrame(self.statements, columns=['Section', 'Statement', 'Seconds'])
+        wall = sections.groupby('Section', sort=False)['Seconds'].sum()
+        sql = sql.groupby('Section')['Seconds'].agg(['count', 'sum'])
+        df = pd.DataFrame({'Wall ms': wall * 1000}).join(sql).fillna(0)
+        df['SQL ms'] = df.pop('sum') * 1000
+        df['Other ms'] = (df['Wall ms'] - df['SQL ms']).clip(lower=0)
+        df = df.rename(columns={'count': 'Queries'}).astype({'Queries': int})
+        return df.reset_index()[['Section', 'Queries', 'SQL ms', 'Other ms', 'Wall ms']].round(1)
+    
+    def statement_frame(self):
+        sql = pd.DataFrame(self.statements, columns=['Section', 'Statement', 'Seconds'])
+        df = sql.groupby(['Section', 'Statement'], sort=False)['Seconds'].agg(['count', 'sum']).reset_index()
+        df = df.rename(columns={'count': 'Count', 'sum': 'Total ms'})
+        df['Total ms'] = (df['Total ms'] * 1000).round(2)
+        df['Repeated'] = df['Count'] >= REPEATED_SQL_THRESHOLD
+        return df.sort_values('Total ms', ascending=False)[['Section', 'Count', 'Total ms', 'Repeated', 'Statement']]
+    
+    def summary(self):
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "page": self.page,
+            "queries": len(self.statements),
+            "sql_ms": round(sum(s[2] for s in self.statements) * 1000, 1),
+            "wall_ms": round(sum(s[1] for s in self.sections) * 1000, 1),
+            "cache_hits": self.cache_hits,
+            "repeated": int(self.statement_frame()['Repeated'].sum()) if self.statements else 0,
+        }
+
+class RunProfiler:
+    # One profile per script-run thread; the engine listeners look it up here
+    def __init__(self):
+        self._local = threading.local()
+    
+    @property
+    def current(self):
+        return getattr(self._local, "profile", None)
+    
+    def start(self):
+        self._local.profile = RunProfile()
+        return self._local.profile
+    
+    def stop(self):
+        self._local.profile = None
+
+@st.cache_resource
+def get_run_profiler():
+    return RunProfiler()
+
+def profile_section(name):
+    profile = get_run_profiler().current
+    if profile is not None:
+        profile.section(name)
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    profile = get_run_profiler().current
+    if profile is not None:
+        profile.record_sql(statement, time.perf_counter() - started)
+
+def write_profile_log(profile):
+    summary = profile.summary()
+    with open(PROFILE_LOG, "a") as f:
+        f.write(json.dumps({**summary, "sections": profile.section_frame().to_dict("records")}) + "\n")
+
+# Engine and session management (DSN and pool settings come from the environment or .env)
+load_dotenv()
+DATABASE_URL = os.getenv("CONTEC_DATABASE_URL", "sqlite:///contec_tracks.db")
+POOL_SIZE = int(os.getenv("CONTEC_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("CONTEC_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.getenv("CONTEC_POOL_TIMEOUT", "30"))
+SUPPORTED_DIALECTS = ("sqlite", "postgresql")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("CONTEC_SQLITE_BUSY_TIMEOUT_MS", "10000"))
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def create_app_engine(url=DATABASE_URL):
+    # Upserts, triggers and migrations are written for these two; anything else fails here, not mid-write
+    backend = make_url(url).get_backend_name()
+    if backend not in SUPPORTED_DIALECTS:
+        raise ValueError(f"unsupported database {backend!r}; use one of {', '.join(SUPPORTED_DIALECTS)}")
+    if backend == "sqlite":
+        # Streamlit serves each browser session from its own thread, so connections must be shareable
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+        )
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    else:
+        engine = create_engine(
+            url,
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+        )
+    event.listen(engine, "after_execute", _track_tables)
+    event.listen(engine, "commit", _invalidate_written_tables)
+    event.listen(engine, "rollback", _discard_written_tables)
+    event.listen(engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine, "after_cursor_execute", _record_query_time)
+    upgrade_schema(engine)
+    return engine
+
+@st.cache_resource
+def get_engine(url=DATABASE_URL):
+    return create_app_engine(url)
+
+# One session per script run (thread); main() removes it when the run ends. The engine (and the schema
+# upgrade) is only created by the first session, so importing this module never touches a database.
+_session_factory = sessionmaker()
+Session = scoped_session(lambda: _session_factory(bind=get_engine()))
+session = Session
+
+TEST_TYPES = [
+    "SQT", "SUMT", "SCL", "SCOSLAB", "SCOSCLEAN", "SPRETS", 
+    "SPPOSTTS", "SPOERUP", "SCOMPLETE", "SSCAN", "SPRO", 
+    "SFAILCOS", "SFAILTEST", "SDETSCAN", "SKIT", "SPACK", 
+    "SSTORE", "SSHIP"
+]
+TEST_LOCATIONS = ["Charlotte", "Sanjose", "Brownsville"]
 
 # Helper functions
 def generate_batch_number(serial_number, customer_name):
+    # The random suffix keeps batches created within the same second apart
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return f"BATCH-{timestamp}-{serial_number[:4]}-{customer_name[:4].upper()}"
+    return f"BATCH-{timestamp}-{serial_number[:4]}-{customer_name[:4].upper()}-{uuid.uuid4().hex[:12].upper()}"
 
 def calculate_storage_days_category(report_date):
     today = datetime.now().date()
@@ -73,8 +925,1440 @@ def calculate_storage_days_category(report_date):
     else:
         return "Over 90 days"
 
+# Page queries shared by main() and the query-plan checks
+def pending_batch_devices_query(session):
+    return session.query(Device).filter(
+        Device.batch_number == None,
+        Device.is_scrap == False
+    )
+
+def pending_tests_query(session, serial_number):
+    return session.query(Test).filter_by(serial_number=serial_number, is_completed=False)
+
+def pending_ship_devices_query(session):
+    return session.query(Device).filter(
+        Device.batch_number != None,
+        Device.ship_date == None,
+        Device.is_scrap == False
+    )
+
+def active_devices_query(session):
+    return session.query(Device).filter(Device.is_scrap == False)
+
+# Typeahead device picker (only the top matches for the typed prefix reach the browser)
+DEVICE_PICKER_LIMIT = 20
+DEVICE_SCOPES = {
+    "active": active_devices_query,
+    "pending_batch": pending_batch_devices_query,
+    "pending_ship": pending_ship_devices_query,
+}
+
+@cached_query
+def search_devices(session, scope, term, limit=DEVICE_PICKER_LIMIT):
+    query = DEVICE_SCOPES[scope](session).with_entities(
+        Device.id, Device.serial_number, Device.model, Device.customer_name, Device.batch_number)
+    term = term.lower()
+    if not term:
+        return query.order_by(func.lower(Device.serial_number)).limit(limit).all()
+    # Serial matches first, then model, then customer; each is a bounded range scan on its search index
+    matches = {}
+    for index in DEVICE_SEARCH_INDEXES:
+        key = index.expressions[-1]
+        for row in query.filter(key >= term, key < _prefix_upper_bound(term)).order_by(key).limit(limit):
+            matches.setdefault(row.id, row)
+        if len(matches) >= limit:
+            break
+    return list(matches.values())[:limit]
+
+@cached_query
+def count_devices(session, scope):
+    return DEVICE_SCOPES[scope](session).count()
+
+def device_selection(session, scope):
+    # The whole scope as a subquery ("select all"), so no serial list is built or bound per device.
+    # Not correlated: it reads devices inside statements that themselves read or update devices.
+    return DEVICE_SCOPES[scope](session).with_entities(Device.serial_number).statement.correlate(None)
+
+def device_serials(session, scope, ids=None):
+    # Re-checks the scope, so devices batched or shipped since they were picked drop out
+    query = DEVICE_SCOPES[scope](session).with_entities(Device.serial_number)
+    if ids is not None:
+        query = query.filter(Device.id.in_(ids))
+    return [serial for (serial,) in query]
+
+def device_label(device):
+    label = f"{device.serial_number} - {device.model} - {device.customer_name}"
+    return f"{label} - Batch: {device.batch_number}" if device.batch_number else label
+
+def device_picker(session, key, scope, label, multiple=False):
+    # Options are Device ids; the label is display only and never parsed back
+    term = st.text_input("Search Devices", key=f"{key}_search",
+                         placeholder="Serial number, model or customer (prefix)").strip()
+    matches = search_devices(session, scope, term)
+    picked = st.session_state.get(f"{key}_pick") if multiple else None
+    labels = {i: text for i, text in st.session_state.get(f"{key}_labels", {}).items() if i in (picked or ())}
+    labels.update((d.id, device_label(d)) for d in matches)
+    st.session_state[f"{key}_labels"] = labels
+    if not multiple:
+        return st.selectbox(label, [d.id for d in matches], format_func=labels.get, key=f"{key}_pick")
+    # Earlier picks stay selected while the search term changes
+    options = list(dict.fromkeys(list(picked or []) + [d.id for d in matches]))
+    return st.multiselect(label, options, format_func=labels.get, key=f"{key}_pick")
+
+# Duplicate-safe inserts (a repeated scan or a retried request is skipped by the database
+# instead of raising IntegrityError and rolling back everything else in the transaction)
+def insert_new(session, table, rows, key):
+    # INSERT ... ON CONFLICT DO NOTHING; returns the key column of each row that actually went in
+    if not rows:
+        return []
+    dialect_insert = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}[session.bind.dialect.name]
+    stmt = dialect_insert(table).on_conflict_do_nothing().returning(table.c[key])
+    return list(session.execute(stmt, rows).scalars())
+
+def register_device(session, device):
+    # False when the serial number is already registered
+    inserted = insert_new(session, Device.__table__, [device], "serial_number")
+    session.commit()
+    return bool(inserted)
+
+def record_test(session, test):
+    # False when a test with the same request_id was already recorded
+    inserted = insert_new(session, Test.__table__, [test], "request_id")
+    session.commit()
+    return bool(inserted)
+
+# Set-based batch and ship operations (one UPDATE per table for any number of devices);
+# serial_numbers is either a list or a device_selection() subquery
+def pending_test_summary(session, serial_numbers):
+    rows = (session.query(
+                Test.serial_number,
+                func.count(Test.id),
+                func.group_concat(Test.test_type, ", ") if session.bind.dialect.name == "sqlite"
+                else func.string_agg(Test.test_type, ", "),
+                func.sum(Test.rate),
+                func.sum(Test.tax))
+            .filter(Test.serial_number.in_(serial_numbers), Test.is_completed == False)
+            .group_by(Test.serial_number)
+            .all())
+    return pd.DataFrame(rows, columns=["Serial Number", "Pending Tests", "Test Types", "Rate", "Tax"])
+
+def pending_batch_preview(session, serial_numbers):
+    # One row per customer (each becomes one batch), for selections too large to list device by device
+    customer = func.coalesce(Device.customer_name, "")
+    rows = (session.query(
+                customer,
+                func.count(func.distinct(Test.serial_number)),
+                func.count(Test.id),
+                func.sum(Test.rate),
+                func.sum(Test.tax))
+            .select_from(Test)
+            .join(Device, Device.serial_number == Test.serial_number)
+            .filter(Test.serial_number.in_(serial_numbers), Test.is_completed == False)
+            .group_by(customer)
+            .all())
+    return pd.DataFrame(rows, columns=["Customer", "Devices", "Pending Tests", "Rate", "Tax"])
+
+def create_batches(session, serial_numbers):
+    # One batch per customer among the selected devices that still have pending tests.
+    # Returns {batch_number: [serial numbers]}; everything commits in one transaction.
+    has_pending = exists().where(Test.serial_number == Device.serial_number, Test.is_completed == False)
+    customer = func.coalesce(Device.customer_name, "")
+    eligible = and_(Device.serial_number.in_(serial_numbers), Device.batch_number == None,
+                    Device.is_scrap == False, has_pending)
+    customers = session.execute(
+        select(customer, func.min(Device.serial_number)).where(eligible).group_by(customer)
+    ).all()
+    
+    batches = {}
+    for customer_name, first_serial in customers:
+        batch_number = generate_batch_number(first_serial, customer_name)
+        # Only devices still unbatched at UPDATE time are claimed; a concurrent batch keeps the rest
+        serials = session.execute(
+            update(Device)
+            .where(eligible, customer == customer_name)
+            .values(batch_number=batch_number)
+            .returning(Device.serial_number),
+            execution_options={"synchronize_session": False}
+        ).scalars().all()
+        if not serials:
+            continue
+        session.execute(
+            update(Test)
+            .where(Test.serial_number.in_(select(Device.serial_number).where(Device.batch_number == batch_number)),
+                   Test.is_completed == False)
+            .values(is_completed=True, batch_number=batch_number),
+            execution_options={"synchronize_session": False}
+        )
+        write_batch_ledger(session.connection(), batch_number, customer_name)
+        batches[batch_number] = serials
+    session.commit()
+    return batches
+
+def ship_devices(session, serial_numbers, ship_date):
+    result = session.execute(
+        update(Device)
+        .where(Device.serial_number.in_(serial_numbers), Device.batch_number != None,
+               Device.ship_date == None, Device.is_scrap == False)
+        .values(ship_date=ship_date),
+        execution_options={"synchronize_session": False}
+    )
+    session.commit()
+    return result.rowcount
+
+# Retention (devices shipped more than RETENTION_DAYS ago, and scrapped devices, move to the archive
+# tables with their tests, so the live tables and every page reading them scale with work in progress)
+RETENTION_DAYS = int(os.getenv("CONTEC_RETENTION_DAYS", "180"))
+ARCHIVE_CHUNK_SIZE = 1000
+
+def archivable_devices_query(session, retention_days=RETENTION_DAYS):
+    # Shipped devices with a test still waiting to be billed stay until it is batched
+    cutoff = datetime.now().date() - timedelta(days=retention_days)
+    has_pending = exists().where(Test.serial_number == Device.serial_number, Test.is_completed == False)
+    return session.query(Device.id).filter(or_(
+        Device.is_scrap == True,
+        and_(Device.is_scrap == False, Device.ship_date <= cutoff, ~has_pending)
+    ))
+
+@cached_query
+def count_archivable_devices(session, retention_days=RETENTION_DAYS):
+    return archivable_devices_query(session, retention_days).count()
+
+def archive_devices(session, retention_days=RETENTION_DAYS, chunk_size=ARCHIVE_CHUNK_SIZE, progress=None):
+    # One transaction per chunk, so operators never wait long behind the write lock.
+    # Returns (devices archived, tests archived); progress(devices archived so far) runs after each chunk.
+    archived_devices = archived_tests = 0
+    device_columns = [c.name for c in Device.__table__.columns]
+    test_columns = [c.name for c in Test.__table__.columns]
+    while True:
+        ids = [device_id for (device_id,) in archivable_devices_query(session, retention_days)
+               .order_by(Device.id).limit(chunk_size)]
+        if not ids:
+            break
+        archived_at = datetime.now()
+        serials = select(Device.serial_number).where(Device.id.in_(ids))
+        archived_tests += session.execute(insert(TestArchive).from_select(
+            test_columns + ["archived_at"],
+            select(*Test.__table__.columns, literal(archived_at, DateTime)).where(Test.serial_number.in_(serials))
+        )).rowcount
+        session.execute(insert(DeviceArchive).from_select(
+            device_columns + ["archived_at"],
+            select(*Device.__table__.columns, literal(archived_at, DateTime)).where(Device.id.in_(ids))
+        ))
+        session.execute(insert(DeviceEvent).from_select(
+            ["serial_number", "event_type", "event_time", "detail"],
+            select(Device.serial_number, literal("archived"), literal(archived_at, DateTime), literal("Archived"))
+            .where(Device.id.in_(ids))
+        ))
+        session.execute(delete(Test).where(Test.serial_number.in_(serials)),
+                        execution_options={"synchronize_session": False})
+        archived_devices += session.execute(delete(Device).where(Device.id.in_(ids)),
+                                            execution_options={"synchronize_session": False}).rowcount
+        session.commit()
+        if progress:
+            progress(archived_devices)
+    return archived_devices, archived_tests
+
+def archived_device_frames(session, serial_number):
+    # On-demand archive lookup: (devices, tests) DataFrames for every archived lifecycle of the serial
+    def frame(dataset, stmt):
+        return pd.DataFrame(session.execute(stmt).all(), columns=[label for label, _ in _export_columns(dataset)])
+    devices = frame("Devices", export_statement("Devices", archived=True).where(DeviceArchive.serial_number == serial_number))
+    tests = frame("Tests", export_statement("Tests", archived=True).where(TestArchive.serial_number == serial_number))
+    return devices, tests
+
+# Test queries select only the id so the plans also run on tables from before later migrations added columns
+PLAN_CHECK_QUERIES = {
+    "Create Batch: devices": pending_batch_devices_query,
+    "Create Batch: pending tests": lambda session: pending_tests_query(session, "SERIAL").with_entities(Test.id),
+    "Ship Devices: devices": pending_ship_devices_query,
+    "Device picker: model prefix": lambda session: active_devices_query(session).filter(
+        func.lower(Device.model) >= "abc", func.lower(Device.model) < "abd").order_by(func.lower(Device.model)),
+    "Financial Summary: completed tests": lambda session: session.query(Test.id).filter(Test.is_completed == True),
+}
+
+def explain_query_plan(session, query):
+    # SQLite only; each returned line is the detail column of EXPLAIN QUERY PLAN
+    sql = query.statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+
+def query_plan_report(session):
+    report = {}
+    for name, build in PLAN_CHECK_QUERIES.items():
+        plan = explain_query_plan(session, build(session))
+        report[name] = (plan, any(line.startswith("SCAN") for line in plan))
+    return report
+
+# Aggregation queries (GROUP BY runs in SQLite, only the plotted rows come back)
+def device_status_expr(device=Device):
+    return case(
+        (device.is_scrap == True, "Scrap"),
+        (device.ship_date != None, "Shipped"),
+        (device.batch_number != None, "Batched"),
+        else_="In Process"
+    )
+
+def device_summary_frame(session):
+    # Not cached: the summary is a handful of rows and is written by triggers the cache cannot see
+    # A day-old summary is shown while a background job rebuilds it; the page never takes the write lock
+    as_of = session.scalar(select(DeviceSummaryMeta.as_of).where(DeviceSummaryMeta.id == 1))
+    today = datetime.now().date()
+    if as_of is not None and as_of < today:
+        enqueue_job(session, "device_summary", {"as_of": today.isoformat()})
+    rows = session.query(DeviceSummary.storage_bucket, DeviceSummary.status, DeviceSummary.customer_name,
+                         DeviceSummary.location, DeviceSummary.device_count).all()
+    return pd.DataFrame(rows + archived_device_summary(session), columns=["Storage Age", "Status", "Customer", "Location", "Count"])
+
+@cached_query
+def archived_device_summary(session):
+    # Archived devices only change when archive_devices runs, so this GROUP BY is nearly always a cache hit
+    status = device_status_expr(DeviceArchive)
+    customer = func.coalesce(DeviceArchive.customer_name, "")
+    location = func.coalesce(DeviceArchive.location, "")
+    return [tuple(row) for row in session.query(literal("Archived"), status, customer, location, func.count())
+            .group_by(status, customer, location).all()]
+
+@cached_query
+def ledger_revenue_by(session, column, label):
+    rows = (session.query(column.label(label), func.sum(BatchLedgerLine.subtotal_cents + BatchLedgerLine.tax_cents))
+            .select_from(BatchLedgerLine)
+            .join(BatchLedger, BatchLedger.batch_number == BatchLedgerLine.batch_number)
+            .group_by(column)
+            .all())
+    return pd.DataFrame([(key, float(cents_to_decimal(cents))) for key, cents in rows], columns=[label, "Total"])
+
+@cached_query
+def ledger_frame(session):
+    rows = (session.query(BatchLedger.batch_number, BatchLedger.customer_name, BatchLedger.created_at,
+                          BatchLedger.test_count, BatchLedger.subtotal_cents, BatchLedger.tax_cents,
+                          BatchLedger.total_cents)
+            .order_by(BatchLedger.created_at.desc())
+            .all())
+    df = pd.DataFrame(rows, columns=["Batch Number", "Customer", "Created", "Tests", "Subtotal", "Tax", "Total"])
+    for label in ("Subtotal", "Tax", "Total"):
+        df[label] = df[label].map(cents_to_decimal)
+    return df
+
+@cached_query
+def ledger_totals(session):
+    # Exact Decimal totals: (revenue, average rate per test, tax)
+    tests, subtotal, tax, total = session.query(
+        func.coalesce(func.sum(BatchLedger.test_count), 0),
+        func.coalesce(func.sum(BatchLedger.subtotal_cents), 0),
+        func.coalesce(func.sum(BatchLedger.tax_cents), 0),
+        func.coalesce(func.sum(BatchLedger.total_cents), 0)
+    ).one()
+    average = (cents_to_decimal(subtotal) / tests).quantize(Decimal("0.01")) if tests else Decimal("0.00")
+    return cents_to_decimal(total), average, cents_to_decimal(tax)
+
+def batch_invoice(session, batch_number):
+    # Returns (ledger row, DataFrame of invoice lines) or (None, None) for an unknown batch
+    header = session.get(BatchLedger, batch_number)
+    if header is None:
+        return None, None
+    rows = (session.query(BatchLedgerLine.test_type, BatchLedgerLine.model, BatchLedgerLine.test_count,
+                          BatchLedgerLine.subtotal_cents, BatchLedgerLine.tax_cents)
+            .filter(BatchLedgerLine.batch_number == batch_number)
+            .order_by(BatchLedgerLine.test_type, BatchLedgerLine.model)
+            .all())
+    lines = pd.DataFrame([
+        (test_type, model, count, cents_to_decimal(subtotal), cents_to_decimal(tax), cents_to_decimal(subtotal + tax))
+        for test_type, model, count, subtotal, tax in rows
+    ], columns=["Test Type", "Model", "Tests", "Subtotal", "Tax", "Total"])
+    return header, lines
+
+# Paged grid queries (only the visible page and a total count leave the database)
+DEVICE_GRID_COLUMNS = {
+    "Report Date": Device.report_date,
+    "Serial Number": Device.serial_number,
+    "Model": Device.model,
+    "Device Type": Device.box_type,
+    "Customer": Device.customer_name,
+    "Location": Device.location,
+    "In-House": case((Device.in_house == True, "Yes"), else_="No"),
+    "Batch Number": func.coalesce(Device.batch_number, "Not assigned"),
+    "Status": case((Device.is_scrap == True, "Scrap"), else_="Active")
+}
+
+TEST_GRID_COLUMNS = {
+    "Test Date": Test.test_date,
+    "Serial Number": Test.serial_number,
+    "Model": Test.model,
+    "Test Type": Test.test_type,
+    "Location": Test.test_location,
+    "Rate": Test.rate,
+    "Tax": Test.tax,
+    "Spare Parts": Test.spare_replacement,
+    "Completed": case((Test.is_completed == True, "Yes"), else_="No"),
+    "Batch Number": func.coalesce(Test.batch_number, "Not assigned")
+}
+
+@cached_query
+def fetch_grid_page(session, model, columns, filters=None, sort_by=None, descending=False, page=1, page_size=10, base_filters=()):
+    # filters maps a column label to a substring; unknown labels are ignored
+    conditions = list(base_filters)
+    for label, term in (filters or {}).items():
+        if term and label in columns:
+            conditions.append(cast(columns[label], String).ilike(f"%{term}%"))
+    
+    total = session.query(func.count(model.id)).filter(*conditions).scalar()
+    pages = max(1, -(-total // page_size))
+    page = min(max(1, page), pages)
+    
+    # id breaks ties so pages stay stable while sorting on non-unique columns
+    order = [model.id.desc() if descending else model.id]
+    if sort_by in columns:
+        order.insert(0, columns[sort_by].desc() if descending else columns[sort_by])
+    
+    rows = (session.query(*[expr.label(label) for label, expr in columns.items()])
+            .filter(*conditions)
+            .order_by(*order)
+            .limit(page_size)
+            .offset((page - 1) * page_size)
+            .all())
+    return pd.DataFrame(rows, columns=list(columns)), total, page
+
+def format_grid_page(df):
+    df = df.copy()
+    for label in ("Report Date", "Test Date"):
+        if label in df:
+            df[label] = df[label].map(lambda d: d.strftime('%Y-%m-%d') if d else "")
+    for label in ("Rate", "Tax"):
+        if label in df:
+            df[label] = df[label].map(lambda v: f"${v:.2f}" if v is not None else "")
+    return df
+
+def render_grid_page(session, key, model, columns, empty_message, base_filters=()):
+    col1, col2, col3, col4 = st.columns([2, 3, 2, 1])
+    with col1:
+        filter_column = st.selectbox("Filter Column", list(columns), key=f"{key}_filter_column")
+    with col2:
+        filter_text = st.text_input("Filter Value", key=f"{key}_filter_text")
+    with col3:
+        sort_by = st.selectbox("Sort By", [None] + list(columns), format_func=lambda c: c or "Default",
+                               key=f"{key}_sort_by")
+    with col4:
+        descending = st.checkbox("Descending", key=f"{key}_descending")
+    
+    profile_section(f"{key} grid: query")
+    page_size = st.session_state.get(f"{key}_page_size", 10)
+    df, total, page = fetch_grid_page(session, model, columns, {filter_column: filter_text}, sort_by, descending,
+                                      st.session_state.get(f"{key}_page", 1), page_size, base_filters)
+    
+    if total == 0:
+        st.info("No records match the filter." if filter_text else empty_message)
+        return None
+    
+    profile_section(f"{key} grid: render")
+    gb = GridOptionsBuilder.from_dataframe(df)
+    gb.configure_selection('single', use_checkbox=True)
+    gb.configure_default_column(groupable=True, value=True, enableRowGroup=True, aggFunc='sum', editable=False)
+    grid_options = gb.build()
+    
+    grid_response = AgGrid(
+        format_grid_page(df),
+        gridOptions=grid_options,
+        height=400,
+        width='100%',
+        data_return_mode='FILTERED_AND_SORTED',
+        update_mode=GridUpdateMode.SELECTION_CHANGED,
+        fit_columns_on_grid_load=True,
+        theme='streamlit',
+        key=f"{key}_grid"
+    )
+    
+    col1, col2, col3 = st.columns([1, 1, 3])
+    with col1:
+        st.number_input("Page", min_value=1, step=1, key=f"{key}_page")
+    with col2:
+        st.selectbox("Rows per page", [10, 25, 50, 100], key=f"{key}_page_size")
+    with col3:
+        first = (page - 1) * page_size + 1
+        st.caption(f"Page {page} of {-(-total // page_size)}, showing {first}-{min(first + page_size - 1, total)} of {total:,}")
+    return grid_response
+
+# Bulk device import (streams CSV/XLSX in chunks, one duplicate check and one INSERT per chunk)
+IMPORT_CHUNK_SIZE = 1000
+
+IMPORT_COLUMN_ALIASES = {
+    "serial_number": "serial_number",
+    "serial": "serial_number",
+    "model": "model",
+    "customer_name": "customer_name",
+    "customer": "customer_name",
+    "report_date": "report_date",
+    "box_type": "box_type",
+    "device_type": "box_type",
+    "location": "location",
+    "in_house": "in_house",
+    "service_code": "service_code",
+}
+
+def _import_header(name):
+    key = str(name or "").strip().lower().replace(" ", "_").replace("-", "_")
+    return IMPORT_COLUMN_ALIASES.get(key)
+
+def iter_import_chunks(source, filename, chunk_size=IMPORT_CHUNK_SIZE):
+    # Yields lists of (row_number, {field: value}); row numbers match the spreadsheet (header is row 1)
+    row_number = 1
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_import_header(name) for name in next(rows, ())]
+        chunk = []
+        for values in rows:
+            row_number += 1
+            chunk.append((row_number, {f: v for f, v in zip(header, values) if f}))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        workbook.close()
+    else:
+        for frame in pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_size):
+            fields = [_import_header(name) for name in frame.columns]
+            chunk = []
+            for values in frame.itertuples(index=False, name=None):
+                row_number += 1
+                chunk.append((row_number, {f: v for f, v in zip(fields, values) if f}))
+            yield chunk
+
+def _clean_text(value):
+    return str(value).strip() if value is not None else ""
+
+def _parse_date(value, default, label):
+    if value in (None, ""):
+        return default
+    if isinstance(value, datetime):
+        return value.date()
+    if hasattr(value, "year"):
+        return value
+    parsed = _parse_date_text(_clean_text(value))
+    if parsed is None:
+        raise ValueError(f"invalid {label} {value!r}")
+    return parsed
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date_text(text):
+    # ISO dates take the fast path; pandas' format guessing is slow, but a file repeats the same few dates
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        pass
+    parsed = pd.to_datetime(text, errors="coerce")
+    return None if pd.isna(parsed) else parsed.date()
+
+def _import_device_row(fields, today):
+    serial_number = _clean_text(fields.get("serial_number"))
+    model = _clean_text(fields.get("model"))
+    customer_name = _clean_text(fields.get("customer_name"))
+    if not serial_number or not model or not customer_name:
+        raise ValueError("missing serial number, model or customer name")
+    if len(serial_number) > 50:
+        raise ValueError("serial number longer than 50 characters")
+    
+    report_date = _parse_date(fields.get("report_date"), today, "report date")
+    
+    in_house = fields.get("in_house", True)
+    if isinstance(in_house, str):
+        in_house = in_house.strip().lower() not in ("no", "n", "false", "0")
+    
+    return {
+        "report_date": report_date,
+        "serial_number": serial_number,
+        "model": model,
+        "box_type": _clean_text(fields.get("box_type")) or "Select",
+        "customer_name": customer_name,
+        "location": _clean_text(fields.get("location")) or "Select",
+        "in_house": bool(in_house),
+        "is_scrap": False,
+        "service_code": _clean_text(fields.get("service_code")) or None,
+        "storage_days_category": calculate_storage_days_category(report_date),
+    }
+
+def import_devices(session, source, filename, chunk_size=IMPORT_CHUNK_SIZE, progress=None, resume_after=0,
+                   before_commit=None):
+    # Returns (inserted count, list of rejects as dicts); progress(rows_seen) is called after each chunk.
+    # The first resume_after data rows were handled by an earlier run; they only feed the duplicate check.
+    # before_commit(rows_seen, inserted, rejects) gets each chunk's outcome inside the chunk's transaction.
+    today = datetime.now().date()
+    seen = set()
+    inserted = 0
+    rejects = []
+    rows_seen = 0
+    
+    for chunk in iter_import_chunks(source, filename, chunk_size):
+        rows_seen += len(chunk)
+        candidates = []
+        chunk_rejects = []
+        for row_number, fields in chunk:
+            # Row numbers count the header as row 1
+            done = row_number - 1 <= resume_after
+            try:
+                device = _import_device_row(fields, today)
+            except ValueError as e:
+                if not done:
+                    chunk_rejects.append({"Row": row_number, "Serial Number": _clean_text(fields.get("serial_number")), "Reason": str(e)})
+                continue
+            if device["serial_number"] in seen:
+                if not done:
+                    chunk_rejects.append({"Row": row_number, "Serial Number": device["serial_number"], "Reason": "duplicate in file"})
+                continue
+            seen.add(device["serial_number"])
+            if not done:
+                candidates.append((row_number, device))
+        
+        registered = set(insert_new(session, Device.__table__, [device for _, device in candidates], "serial_number"))
+        for row_number, device in candidates:
+            if device["serial_number"] not in registered:
+                chunk_rejects.append({"Row": row_number, "Serial Number": device["serial_number"], "Reason": "already registered"})
+        if before_commit:
+            before_commit(rows_seen, len(registered), chunk_rejects)
+        session.commit()
+        
+        rejects.extend(chunk_rejects)
+        inserted += len(registered)
+        if progress:
+            progress(rows_seen)
+    
+    return inserted, rejects
+
+# Bulk test ingestion for automated test stations (no Streamlit involved)
+INGEST_BATCH_SIZE = 2000
+MODEL_CACHE_SIZE = 100000
+
+def _ingest_test_row(fields, today):
+    serial_number = _clean_text(fields.get("serial_number"))
+    test_type = _clean_text(fields.get("test_type")).upper()
+    if not serial_number:
+        raise ValueError("missing serial number")
+    if test_type not in TEST_TYPES:
+        raise ValueError(f"unknown test type {test_type!r}")
+    
+    test_date = _parse_date(fields.get("test_date"), today, "test date")
+    
+    try:
+        rate = float(fields.get("rate") or 0.0)
+        tax = float(fields.get("tax") or 0.0)
+    except (TypeError, ValueError):
+        raise ValueError("rate and tax must be numbers")
+    if not math.isfinite(rate) or not math.isfinite(tax):
+        raise ValueError("rate and tax must be finite numbers")
+    if rate < 0 or tax < 0:
+        raise ValueError("rate and tax cannot be negative")
+    
+    request_id = _clean_text(fields.get("request_id")) or None
+    if request_id and len(request_id) > 64:
+        raise ValueError("request id longer than 64 characters")
+    
+    return {
+        "serial_number": serial_number,
+        "test_type": test_type,
+        "test_date": test_date,
+        "test_location": _clean_text(fields.get("test_location")) or None,
+        "rate": rate,
+        "tax": tax,
+        "spare_replacement": _clean_text(fields.get("spare_replacement")) or None,
+        "notes": _clean_text(fields.get("notes")) or None,
+        "is_completed": False,
+        "request_id": request_id,
+    }
+
+def ingest_tests(session, records, batch_size=INGEST_BATCH_SIZE, model_cache=None):
+    # records is any iterable of dicts; returns (inserted count, list of rejects as dicts).
+    # Models are resolved once per batch for serials missing from model_cache, so a station
+    # streaming the same devices through several tests only looks each serial up once.
+    # Records carrying a request_id already seen are skipped, so a station can safely resend.
+    today = datetime.now().date()
+    model_cache = {} if model_cache is None else model_cache
+    inserted = 0
+    rejects = []
+    
+    def flush(batch):
+        missing = {row["serial_number"] for _, row in batch} - model_cache.keys()
+        if missing:
+            if len(model_cache) + len(missing) > MODEL_CACHE_SIZE:
+                model_cache.clear()
+            model_cache.update(session.execute(
+                select(Device.serial_number, Device.model)
+                .where(Device.serial_number.in_(missing), Device.is_scrap == False)
+            ).all())
+        rows = []
+        requests = set()
+        for index, row in batch:
+            if row["serial_number"] not in model_cache:
+                rejects.append({"Record": index, "Serial Number": row["serial_number"], "Reason": "device not registered or scrapped"})
+                continue
+            if row["request_id"] in requests:
+                rejects.append({"Record": index, "Serial Number": row["serial_number"], "Reason": "duplicate request"})
+                continue
+            if row["request_id"]:
+                requests.add(row["request_id"])
+            row["model"] = model_cache[row["serial_number"]]
+            rows.append((index, row))
+        recorded = insert_new(session, Test.__table__, [row for _, row in rows], "request_id")
+        session.commit()
+        if len(recorded) < len(rows):
+            recorded = set(recorded)
+            for index, row in rows:
+                if row["request_id"] not in recorded:
+                    rejects.append({"Record": index, "Serial Number": row["serial_number"], "Reason": "already recorded"})
+        return len(recorded)
+    
+    batch = []
+    for index, fields in enumerate(records, start=1):
+        try:
+            batch.append((index, _ingest_test_row(fields, today)))
+        except ValueError as e:
+            rejects.append({"Record": index, "Serial Number": _clean_text(fields.get("serial_number")), "Reason": str(e)})
+            continue
+        if len(batch) >= batch_size:
+            inserted += flush(batch)
+            batch = []
+    if batch:
+        inserted += flush(batch)
+    
+    return inserted, rejects
+
+# Streaming export (rows are fetched and written chunk by chunk, so memory stays flat)
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = ["CSV", "XLSX", "Parquet"]
+# The browser download has to hold the whole file in memory, so larger exports go through export_data.py
+EXPORT_DOWNLOAD_MAX_BYTES = 50 * 1024 * 1024
+
+def _export_columns(dataset, device=Device, test=Test):
+    if dataset == "Devices":
+        return [
+            ("Report Date", device.report_date),
+            ("Serial Number", device.serial_number),
+            ("Model", device.model),
+            ("Device Type", device.box_type),
+            ("Customer", device.customer_name),
+            ("Location", device.location),
+            ("In-House", device.in_house),
+            ("Scrap", device.is_scrap),
+            ("Storage Age", device.storage_days_category),
+            ("Batch Number", device.batch_number),
+            ("Ship Date", device.ship_date),
+        ]
+    rate, tax = test.rate, test.tax
+    if dataset == "Billing":
+        # Money rounded to cents per test in SQL, so the export adds up to the ledger to the cent
+        rate_cents, tax_cents = _test_cents(test.rate), _test_cents(test.tax)
+        rate, tax = cast(rate_cents, Float) / 100, cast(tax_cents, Float) / 100
+    columns = [
+        ("Test Date", test.test_date),
+        ("Serial Number", test.serial_number),
+        ("Customer", device.customer_name),
+        ("Model", test.model),
+        ("Test Type", test.test_type),
+        ("Location", test.test_location),
+        ("Rate", rate),
+        ("Tax", tax),
+    ]
+    if dataset == "Billing":
+        return [("Batch Number", test.batch_number)] + columns + [("Total", cast(rate_cents + tax_cents, Float) / 100)]
+    return columns + [
+        ("Spare Parts", test.spare_replacement),
+        ("Notes", test.notes),
+        ("Completed", test.is_completed),
+        ("Batch Number", test.batch_number),
+    ]
+
+EXPORT_DATASETS = ["Devices", "Tests", "Billing"]
+
+def export_statement(dataset, start_date=None, end_date=None, customer_name=None, batch_number=None, archived=False):
+    # archived=True reads the same columns from devices_archive and tests_archive
+    device, test = (DeviceArchive, TestArchive) if archived else (Device, Test)
+    columns = _export_columns(dataset, device, test)
+    stmt = select(*[expr.label(label) for label, expr in columns])
+    if dataset == "Devices":
+        date_column, batch_column, order = device.report_date, device.batch_number, device.id
+    else:
+        on = device.serial_number == test.serial_number
+        if archived:
+            on = and_(on, device.archived_at == test.archived_at)
+        stmt = stmt.select_from(test).outerjoin(device, on)
+        date_column, batch_column, order = test.test_date, test.batch_number, test.id
+        if dataset == "Billing":
+            stmt = stmt.where(test.is_completed == True)
+    if start_date:
+        stmt = stmt.where(date_column >= start_date)
+    if end_date:
+        stmt = stmt.where(date_column <= end_date)
+    if customer_name:
+        stmt = stmt.where(device.customer_name == customer_name)
+    if batch_number:
+        stmt = stmt.where(batch_column == batch_number)
+    return stmt.order_by(order)
+
+def _export_partitions(session, statements, chunk_size):
+    # Live rows first, then archived ones, each streamed in chunks
+    for stmt in statements:
+        result = session.execute(stmt, execution_options={"yield_per": chunk_size})
+        yield from result.partitions()
+        result.close()
+
+def _arrow_schema(dataset):
+    import pyarrow as pa
+    types = {Date: pa.date32(), Float: pa.float64(), Integer: pa.int64(), Boolean: pa.bool_()}
+    fields = []
+    for label, expr in _export_columns(dataset):
+        arrow_type = next((t for sql_type, t in types.items() if isinstance(expr.type, sql_type)), pa.string())
+        fields.append(pa.field(label, arrow_type))
+    return pa.schema(fields)
+
+def write_export(session, out, dataset, fmt, start_date=None, end_date=None, customer_name=None,
+                 batch_number=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # out is a binary file object; returns the number of rows written. Archived rows are included,
+    # so billing exports still add up to the ledger after archive_devices has run.
+    statements = [export_statement(dataset, start_date, end_date, customer_name, batch_number, archived)
+                  for archived in (False, True)]
+    header = [label for label, _ in _export_columns(dataset)]
+    partitions = _export_partitions(session, statements, chunk_size)
+    written = 0
+    
+    if fmt == "CSV":
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(header)
+        for rows in partitions:
+            writer.writerows(rows)
+            written += len(rows)
+        text.flush()
+        text.detach()
+    elif fmt == "XLSX":
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(dataset)
+        sheet.append(header)
+        for rows in partitions:
+            for row in rows:
+                sheet.append(list(row))
+            written += len(rows)
+        workbook.save(out)
+    elif fmt == "Parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = _arrow_schema(dataset)
+        with pq.ParquetWriter(out, schema) as writer:
+            for rows in partitions:
+                writer.write_table(pa.Table.from_pylist([dict(zip(header, row)) for row in rows], schema=schema))
+                written += len(rows)
+            if not written:
+                writer.write_table(schema.empty_table())
+    else:
+        raise ValueError(f"unknown export format {fmt!r}")
+    return written
+
+# Analytics snapshot (Parquet copies of devices and tests, one partition per month with rows clustered by
+# customer). Reports read the snapshot with pandas, so long renders never hold the operators' database.
+SNAPSHOT_DIR = os.getenv("CONTEC_SNAPSHOT_DIR", "analytics_snapshot")
+SNAPSHOT_MAX_AGE = int(os.getenv("CONTEC_SNAPSHOT_MAX_AGE", "900"))
+SNAPSHOT_ROW_GROUP_SIZE = 64000
+SNAPSHOT_DATASETS = {"devices": ("Devices", "Report Date"), "tests": ("Tests", "Test Date")}
+# Free-text columns are written for completeness but never loaded by the reports
+SNAPSHOT_SKIP_COLUMNS = {"Spare Parts", "Notes"}
+
+def snapshot_watermark(session):
+    # The event log grows on every device or test write (triggers on SQLite and PostgreSQL), so its last id
+    # marks the data version
+    return session.query(func.max(DeviceEvent.id)).scalar()
+
+def _snapshot_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive")
+
+def _snapshot_schema(dataset):
+    import pyarrow as pa
+    return _arrow_schema(dataset).append(pa.field("month", pa.string()))
+
+def _snapshot_dataset(path, dataset):
+    import pyarrow.dataset as ds
+    return ds.dataset(path, schema=_snapshot_schema(dataset), format="parquet", partitioning=_snapshot_partitioning())
+
+def _snapshot_batches(partitions, schema, date_label):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    for rows in partitions:
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+        month = pc.strftime(table[date_label].cast(pa.timestamp("s")), format="%Y-%m")
+        yield from table.append_column("month", month).to_batches()
+
+def build_analytics_snapshot(session, snapshot_dir=SNAPSHOT_DIR, chunk_size=EXPORT_CHUNK_SIZE):
+    # Each build goes to its own directory and manifest.json is swapped last, so readers never see a partial
+    # snapshot. Returns the manifest.
+    import pyarrow.dataset as ds
+    watermark = snapshot_watermark(session)
+    built_at = datetime.now()
+    version = built_at.strftime("%Y%m%d%H%M%S%f")
+    rows = {}
+    for name, (dataset, date_label) in SNAPSHOT_DATASETS.items():
+        path = os.path.join(snapshot_dir, version, name)
+        os.makedirs(path)
+        # Customer order gives each month's row groups narrow customer min/max statistics to prune on;
+        # archived devices and tests are appended so reports keep covering the whole history
+        statements = [export_statement(dataset, archived=archived).order_by(None).order_by("Customer", date_label)
+                      for archived in (False, True)]
+        partitions = _export_partitions(session, statements, chunk_size)
+        ds.write_dataset(_snapshot_batches(partitions, _arrow_schema(dataset), date_label), path,
+                         schema=_snapshot_schema(dataset), format="parquet", partitioning=_snapshot_partitioning(),
+                         basename_template="part-{i}.parquet", min_rows_per_group=SNAPSHOT_ROW_GROUP_SIZE,
+                         max_rows_per_group=SNAPSHOT_ROW_GROUP_SIZE, max_partitions=10000)
+        rows[name] = _snapshot_dataset(path, dataset).count_rows()
+    
+    manifest = {"version": version, "built_at": built_at.isoformat(timespec="seconds"), "watermark": watermark, "rows": rows}
+    # Never swap back to an older build (callers hold snapshot_build_lock, this is the last line of defence)
+    current = read_snapshot_manifest(snapshot_dir)
+    if current is not None and current["version"] >= version:
+        shutil.rmtree(os.path.join(snapshot_dir, version), ignore_errors=True)
+        return current
+    with tempfile.NamedTemporaryFile("w", dir=snapshot_dir, suffix=".tmp", delete=False) as f:
+        json.dump(manifest, f)
+    os.replace(f.name, os.path.join(snapshot_dir, "manifest.json"))
+    # Keep the previous version for readers that are still loading it
+    versions = sorted(v for v in os.listdir(snapshot_dir) if os.path.isdir(os.path.join(snapshot_dir, v)))
+    for old in versions[:max(versions.index(version) - 1, 0)]:
+        shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+    return manifest
+
+def read_snapshot_manifest(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+class AnalyticsSnapshot:
+    def __init__(self, snapshot_dir, manifest):
+        self.path = os.path.join(snapshot_dir, manifest["version"])
+        self.version = manifest["version"]
+        self.built_at = datetime.fromisoformat(manifest["built_at"])
+        self.watermark = manifest["watermark"]
+        self._frames = {}
+        self._lock = threading.Lock()
+    
+    def frame(self, name):
+        # Loaded once per snapshot and shared across sessions, so callers must treat it as read-only
+        with self._lock:
+            if name not in self._frames:
+                dataset = _snapshot_dataset(os.path.join(self.path, name), SNAPSHOT_DATASETS[name][0])
+                columns = [c for c in dataset.schema.names if c not in SNAPSHOT_SKIP_COLUMNS]
+                self._frames[name] = dataset.to_table(columns=columns).to_pandas(date_as_object=False)
+            return self._frames[name]
+
+@st.cache_resource(max_entries=2)
+def open_analytics_snapshot(snapshot_dir, version):
+    manifest = read_snapshot_manifest(snapshot_dir)
+    return AnalyticsSnapshot(snapshot_dir, manifest) if manifest and manifest["version"] == version else None
+
+def load_analytics_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    manifest = read_snapshot_manifest(snapshot_dir)
+    return open_analytics_snapshot(snapshot_dir, manifest["version"]) if manifest else None
+
+@st.cache_resource
+def get_snapshot_lock():
+    return threading.Lock()
+
+@contextlib.contextmanager
+def snapshot_build_lock(snapshot_dir=SNAPSHOT_DIR):
+    # Serialises builds across threads and processes (the app's job workers and a cron snapshot.py)
+    # with an OS lock on a file in the snapshot directory
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with get_snapshot_lock(), open(os.path.join(snapshot_dir, ".lock"), "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def refresh_analytics_snapshot(session, snapshot_dir=SNAPSHOT_DIR):
+    # Queued as a background job; one rebuild per data version and minute however many pages ask
+    pending = session.query(Job).filter(Job.kind == "analytics_snapshot", Job.status.in_(("queued", "running"))).first()
+    if pending is not None:
+        return pending
+    params = {"snapshot_dir": snapshot_dir, "watermark": snapshot_watermark(session),
+              "requested": datetime.now().strftime("%Y-%m-%d %H:%M")}
+    return enqueue_job(session, "analytics_snapshot", params)
+
+def current_analytics_snapshot(session, snapshot_dir=SNAPSHOT_DIR):
+    snapshot = load_analytics_snapshot(snapshot_dir)
+    if snapshot is None:
+        with snapshot_build_lock(snapshot_dir):
+            if read_snapshot_manifest(snapshot_dir) is None:
+                build_analytics_snapshot(session, snapshot_dir)
+        return load_analytics_snapshot(snapshot_dir)
+    age = (datetime.now() - snapshot.built_at).total_seconds()
+    if age > SNAPSHOT_MAX_AGE and (snapshot.watermark is None or snapshot_watermark(session) != snapshot.watermark):
+        refresh_analytics_snapshot(session, snapshot_dir)
+    return snapshot
+
+def cached_report(fn):
+    # Report frames derive from one immutable snapshot version, so the version is part of the key
+    @functools.wraps(fn)
+    def wrapper(snapshot, *args):
+        cache = get_query_cache()
+        key = (fn.__name__, snapshot.version, _cache_key(args))
+        hit, value = cache.get(key)
+        if hit:
+            return value
+        value = fn(snapshot, *args)
+        cache.put(key, (), value)
+        return value
+    return wrapper
+
+@cached_report
+def count_by(snapshot, dataset, column, label):
+    return snapshot.frame(dataset)[column].value_counts().rename_axis(label).reset_index(name="Count")
+
+@cached_report
+def test_completion_counts(snapshot):
+    completed = snapshot.frame("tests")["Completed"].map({True: "Yes", False: "No"})
+    return completed.value_counts().rename_axis("Completed").reset_index(name="Count")
+
+@cached_report
+def test_counts_by_model(snapshot):
+    tests = snapshot.frame("tests")
+    return tests.groupby(["Model", "Test Type"], observed=True).size().reset_index(name="Count")
+
+@cached_report
+def average_rate_by_test_type(snapshot):
+    return snapshot.frame("tests").groupby("Test Type", observed=True)["Rate"].mean().reset_index()
+
+@cached_report
+def rate_tax_density(snapshot):
+    # Completed-test totals binned on a rate x tax grid instead of one marker per test
+    tests = snapshot.frame("tests")
+    completed = tests[tests["Completed"] == True]
+    grid = binned_density(completed["Rate"], completed["Tax"], completed["Rate"] + completed["Tax"])
+    return grid.rename(columns={"x": "Rate", "y": "Tax"})
+
+def _days_in_system(report_dates):
+    today = pd.Timestamp(datetime.now().date())
+    return (today - report_dates).dt.days.fillna(0).astype(int)
+
+@cached_report
+def device_days_in_system(snapshot):
+    return binned_counts(_days_in_system(snapshot.frame("devices")["Report Date"]), "Days in System")
+
+@cached_report
+def device_report_frame(snapshot):
+    devices = snapshot.frame("devices")
+    status = np.select(
+        [devices["Scrap"] == True, devices["Ship Date"].notna(), devices["Batch Number"].notna()],
+        ["Scrap", "Shipped", "Batched"],
+        default="In Process"
+    )
+    return pd.DataFrame({
+        "Serial Number": devices["Serial Number"],
+        "Model": devices["Model"],
+        "Customer": devices["Customer"],
+        "Location": devices["Location"],
+        "Status": status,
+        "Days in System": _days_in_system(devices["Report Date"]),
+        "Batch Number": devices["Batch Number"].fillna("Not assigned"),
+    })
+
+@cached_report
+def test_report_frame(snapshot):
+    tests = snapshot.frame("tests")
+    return pd.DataFrame({
+        "Test Type": tests["Test Type"],
+        "Model": tests["Model"],
+        "Location": tests["Location"],
+        "Rate": tests["Rate"],
+        "Completed": tests["Completed"].map({True: "Yes", False: "No"}),
+        "Batch Number": tests["Batch Number"].fillna("Not assigned"),
+    })
+
+# Chart data preparation (every figure gets a bounded number of bars, cells or points however large the data)
+CHART_TOP_N = 15
+CHART_BINS = 30
+CHART_MAX_BUCKETS = 120
+REPORT_TABLE_ROWS = 1000
+TIME_BUCKETS = [("D", "Day", 1), ("W", "Week", 7), ("MS", "Month", 31), ("QS", "Quarter", 92), ("YS", "Year", 366)]
+
+def top_n(df, label, value, n=CHART_TOP_N, keys=()):
+    # Keeps the n largest categories of label (by total value) and folds the rest into "Other"
+    totals = df.groupby(label, observed=True)[value].sum()
+    if len(totals) > n:
+        kept = totals.nlargest(n).index
+        df = df.assign(**{label: df[label].astype(object).where(df[label].isin(kept), "Other")})
+    df = df.groupby([label, *keys], observed=True, as_index=False)[value].sum()
+    order = df.groupby(label)[value].transform("sum").where(df[label] != "Other", -1)
+    return df.assign(_order=order).sort_values("_order", ascending=False).drop(columns="_order")
+
+def binned_counts(values, label, weights=None, bins=CHART_BINS):
+    # Integer values (days) in at most `bins` bins of a whole-number width, so every label is distinct
+    low, high = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    width = -(-(high - low + 1) // bins)
+    edges = low + width * np.arange(-(-(high - low + 1) // width) + 1)
+    counts, _ = np.histogram(values, bins=edges, weights=weights)
+    labels = [f"{a:,}" if width == 1 else f"{a:,}-{a + width - 1:,}" for a in edges[:-1]]
+    return pd.DataFrame({label: labels, "Count": counts})
+
+def binned_density(x, y, weights, bins=CHART_BINS):
+    # Weighted 2-D histogram as (x, y, total) cell centres; empty cells are dropped
+    totals, x_edges, y_edges = np.histogram2d(x, y, bins=bins, weights=weights)
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+    grid = pd.DataFrame({"x": np.repeat(x_centres, bins), "y": np.tile(y_centres, bins), "Total": totals.ravel()})
+    return grid[grid["Total"] > 0]
+
+def time_bucket(dates, max_buckets=CHART_MAX_BUCKETS):
+    # Finest of day/week/month/quarter/year that keeps the series under max_buckets points
+    span = (dates.max() - dates.min()).days + 1 if dates.notna().any() else 1
+    for freq, name, days in TIME_BUCKETS:
+        if span / days <= max_buckets:
+            return freq, name
+    return TIME_BUCKETS[-1][:2]
+
+def bucketed_sum(frame, date_column, value_columns, max_buckets=CHART_MAX_BUCKETS):
+    freq, name = time_bucket(frame[date_column], max_buckets)
+    series = frame.dropna(subset=[date_column]).resample(freq, on=date_column)[value_columns].sum()
+    return series.rename_axis(name).reset_index(), name
+
+@cached_report
+def test_throughput(snapshot):
+    tests = snapshot.frame("tests")
+    counts = pd.DataFrame({"Test Date": tests["Test Date"], "Tests": 1, "Completed": tests["Completed"].astype(int)})
+    return bucketed_sum(counts, "Test Date", ["Tests", "Completed"])
+
+@cached_report
+def revenue_over_time(snapshot):
+    tests = snapshot.frame("tests")
+    completed = tests[tests["Completed"] == True]
+    revenue = pd.DataFrame({"Test Date": completed["Test Date"], "Revenue": completed["Rate"] + completed["Tax"]})
+    return bucketed_sum(revenue, "Test Date", ["Revenue"])
+
+# Background jobs (a database-backed queue worked by a small thread pool, so long operations outlive reruns).
+# A job's idempotency key is derived from its parameters, so a double click, a rerun or a second browser tab
+# gets the existing job back instead of applying the work twice.
+JOB_WORKERS = int(os.getenv("CONTEC_JOB_WORKERS", "2"))
+JOB_FILES_DIR = os.getenv("CONTEC_JOB_FILES_DIR", "job_files")
+JOB_POLL_SECONDS = 1.0
+JOB_RETRY_DELAY = 5
+# A running job whose worker stopped heartbeating for this long is picked up again
+JOB_STALE_AFTER = timedelta(minutes=10)
+JOB_REJECT_PREVIEW = 200
+IMPORT_REJECT_COLUMNS = ["Row", "Serial Number", "Reason"]
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def job_key(kind, params):
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return f"{kind}:{digest[:40]}"
+
+def enqueue_job(session, kind, params, key=None, max_attempts=3):
+    # Returns the job for the key, creating it if needed; a failed job is queued again, anything else is left alone
+    key = key or job_key(kind, params)
+    now = datetime.now()
+    job = session.query(Job).filter_by(idempotency_key=key).first()
+    if job is None:
+        # Two sessions enqueueing the same key both end up with the one row
+        insert_new(session, Job.__table__, [dict(
+            kind=kind, idempotency_key=key, params=json.dumps(params, default=str), status="queued",
+            progress=0.0, attempts=0, max_attempts=max_attempts, created_at=now, run_after=now)], "id")
+        session.commit()
+        job = session.query(Job).filter_by(idempotency_key=key).one()
+    elif job.status == "failed":
+        job.status, job.attempts, job.error, job.run_after, job.finished_at = "queued", 0, None, now, None
+        session.commit()
+    return job
+
+def _claimable(now):
+    return or_(and_(Job.status == "queued", Job.run_after <= now),
+               and_(Job.status == "running", Job.heartbeat_at < now - JOB_STALE_AFTER))
+
+def claim_job(session, worker):
+    # Conditional UPDATE, so two workers (or two processes) never claim the same job
+    now = datetime.now()
+    job_id = session.query(Job.id).filter(_claimable(now)).order_by(Job.id).limit(1).scalar()
+    if job_id is None:
+        return None
+    claimed = session.execute(
+        update(Job)
+        .where(Job.id == job_id, _claimable(now))
+        .values(status="running", attempts=Job.attempts + 1, worker=worker, started_at=now, heartbeat_at=now),
+        execution_options={"synchronize_session": False}
+    ).rowcount
+    session.commit()
+    return job_id if claimed else None
+
+def _update_job(session, job_id, **values):
+    session.execute(update(Job).where(Job.id == job_id).values(**values), execution_options={"synchronize_session": False})
+    session.commit()
+
+def run_job(job_id):
+    session = Session()
+    try:
+        # Handlers that checkpoint find their job here
+        session.info["job_id"] = job_id
+        job = session.get(Job, job_id)
+        kind, params, attempts, max_attempts = job.kind, job.params, job.attempts, job.max_attempts
+        session.rollback()
+        
+        def progress(fraction=None, message=None):
+            # Written on its own connection; handlers call it between their own commits
+            values = {"heartbeat_at": datetime.now()}
+            if fraction is not None:
+                values["progress"] = fraction
+            if message is not None:
+                values["message"] = message[:200]
+            with get_engine().begin() as conn:
+                conn.execute(update(Job).where(Job.id == job_id).values(**values))
+        
+        try:
+            result = JOB_HANDLERS[kind](session, json.loads(params), progress)
+        except Exception as e:
+            session.rollback()
+            now = datetime.now()
+            if attempts < max_attempts:
+                _update_job(session, job_id, status="queued", error=f"{type(e).__name__}: {e}"[:500],
+                            run_after=now + timedelta(seconds=JOB_RETRY_DELAY * 2 ** (attempts - 1)))
+            else:
+                _update_job(session, job_id, status="failed", error=f"{type(e).__name__}: {e}"[:500], finished_at=now)
+            return
+        _update_job(session, job_id, status="succeeded", progress=1.0, result=json.dumps(result, default=str),
+                    error=None, finished_at=datetime.now())
+    finally:
+        Session.remove()
+
+class JobRunner:
+    def __init__(self, workers=JOB_WORKERS):
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True) for i in range(workers)]
+    
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+    
+    def wait(self):
+        while any(thread.is_alive() for thread in self._threads):
+            self._stop.wait(JOB_POLL_SECONDS)
+    
+    def _work(self):
+        worker = f"{os.getpid()}:{threading.current_thread().name}"
+        while not self._stop.is_set():
+            try:
+                job_id = claim_job(Session(), worker)
+            except Exception:
+                # Usually a locked database; the next poll tries again
+                job_id = None
+            finally:
+                Session.remove()
+            if job_id is None:
+                self._stop.wait(JOB_POLL_SECONDS)
+            else:
+                run_job(job_id)
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner().start() if JOB_WORKERS else None
+
+def recent_jobs(session, limit=10):
+    return session.query(Job).populate_existing().order_by(Job.id.desc()).limit(limit).all()
+
+def job_selection(session, params):
+    # Batch and ship jobs carry picked serials, or a device scope for "select all" (resolved when the job runs)
+    if "scope" in params:
+        return device_selection(session, params["scope"]), f"all {params['scope'].replace('_', ' ')} devices"
+    return params["serials"], f"{len(params['serials']):,} devices"
+
+def select_all_params(session, scope):
+    # The event watermark keys the job, so a double click queues one job but new devices make a new one
+    return {"scope": scope, "watermark": snapshot_watermark(session)}
+
+@job_handler("create_batches")
+def _create_batches_job(session, params, progress):
+    selection, label = job_selection(session, params)
+    progress(0.0, f"Batching {label}")
+    batches = create_batches(session, selection)
+    return {"batches": {batch_number: len(serials) for batch_number, serials in batches.items()}}
+
+@job_handler("ship_devices")
+def _ship_devices_job(session, params, progress):
+    selection, label = job_selection(session, params)
+    progress(0.0, f"Shipping {label}")
+    return {"shipped": ship_devices(session, selection, datetime.strptime(params["ship_date"], "%Y-%m-%d").date())}
+
+def job_checkpoint(session):
+    # The running job's last checkpoint (kept in result until the job succeeds), or None on a first attempt
+    result = session.scalar(select(Job.result).where(Job.id == session.info["job_id"]))
+    return json.loads(result) if result else None
+
+def save_job_checkpoint(session, state):
+    # Written in the caller's transaction, so it commits or rolls back with the work it describes
+    session.execute(update(Job).where(Job.id == session.info["job_id"]).values(result=json.dumps(state)),
+                    execution_options={"synchronize_session": False})
+
+@job_handler("import_devices")
+def _import_devices_job(session, params, progress):
+    # Each chunk commits with a checkpoint, so a retry resumes after the last committed chunk and rows an earlier
+    # attempt registered are counted, not rejected as already registered. Every reject is appended to a CSV next
+    # to the upload; the checkpoint keeps its length, so rejects of a rolled-back chunk are cut off again.
+    state = job_checkpoint(session) or {"rows": 0, "inserted": 0, "rejected": 0, "rejects_bytes": 0}
+    rejects_path = params["path"] + ".rejects.csv"
+    with open(rejects_path, "a+", encoding="utf-8", newline="") as rejects_file:
+        rejects_file.truncate(state["rejects_bytes"])
+        writer = csv.DictWriter(rejects_file, IMPORT_REJECT_COLUMNS)
+        if not state["rejects_bytes"]:
+            writer.writeheader()
+        
+        def before_commit(rows_seen, inserted, rejects):
+            writer.writerows(rejects)
+            rejects_file.flush()
+            state.update(rows=rows_seen, inserted=state["inserted"] + inserted, rejected=state["rejected"] + len(rejects),
+                         rejects_bytes=rejects_file.tell())
+            save_job_checkpoint(session, state)
+        
+        with open(params["path"], "rb") as source:
+            import_devices(session, source, params["filename"], resume_after=state["rows"], before_commit=before_commit,
+                           progress=lambda rows: progress(None, f"{rows:,} rows processed"))
+    os.remove(params["path"])
+    with open(rejects_path, encoding="utf-8", newline="") as rejects_file:
+        preview = list(itertools.islice(csv.DictReader(rejects_file), JOB_REJECT_PREVIEW))
+    return {"inserted": state["inserted"], "rejected": state["rejected"], "rejects": preview, "rejects_file": rejects_path}
+
+@job_handler("archive_devices")
+def _archive_devices_job(session, params, progress):
+    devices, tests = archive_devices(session, params["retention_days"],
+                                     progress=lambda devices: progress(None, f"{devices:,} devices archived"))
+    return {"devices": devices, "tests": tests}
+
+@job_handler("device_summary")
+def _device_summary_job(session, params, progress):
+    return {"rebuilt": roll_forward_device_summary(session)}
+
+@job_handler("analytics_snapshot")
+def _analytics_snapshot_job(session, params, progress):
+    with snapshot_build_lock(params["snapshot_dir"]):
+        return build_analytics_snapshot(session, params["snapshot_dir"])
+
+def job_summary(job):
+    if job.status != "succeeded":
+        return None
+    result = json.loads(job.result)
+    if job.kind == "create_batches":
+        return "\n".join(f"Batch {number} created for {count:,} devices." for number, count in result["batches"].items()) \
+            or "No devices with pending tests were left to batch."
+    if job.kind == "ship_devices":
+        return f"{result['shipped']:,} devices shipped."
+    if job.kind == "import_devices":
+        return f"{result['inserted']:,} devices registered, {result['rejected']:,} rows rejected."
+    if job.kind == "archive_devices":
+        return f"{result['devices']:,} devices and {result['tests']:,} tests archived."
+    if job.kind == "device_summary":
+        return "Device aging summary rolled forward."
+    if job.kind == "analytics_snapshot":
+        return f"Analytics snapshot rebuilt: {result['rows']['devices']:,} devices, {result['rows']['tests']:,} tests."
+    return "Done."
+
+def enqueue_archive(session, retention_days=RETENTION_DAYS):
+    # Like snapshot refreshes, at most one archive run is queued at a time
+    pending = session.query(Job).filter(Job.kind == "archive_devices", Job.status.in_(("queued", "running"))).first()
+    if pending is not None:
+        return pending
+    params = {"retention_days": retention_days, "requested": datetime.now().strftime("%Y-%m-%d %H:%M")}
+    return enqueue_job(session, "archive_devices", params)
+
+def enqueue_device_import(session, filename, data):
+    # The upload is parked on disk for the worker; identical files map to the same job
+    digest = hashlib.sha256(data).hexdigest()
+    key = f"import_devices:{digest[:40]}"
+    path = os.path.join(JOB_FILES_DIR, digest + os.path.splitext(filename)[1].lower())
+    job = session.query(Job).filter_by(idempotency_key=key).first()
+    # Only a new or failed job needs the file; a queued or running worker may be reading it
+    if job is None or job.status == "failed":
+        os.makedirs(JOB_FILES_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return enqueue_job(session, "import_devices", {"path": path, "filename": filename}, key)
+
 # Streamlit app
+@st.fragment(run_every=JOB_POLL_SECONDS * 2)
+def job_status(job_id):
+    # Fragment reruns never reach the page's Session.remove(), so each poll uses and closes its own session
+    with _session_factory(bind=get_engine()) as poll:
+        job = poll.get(Job, job_id)
+    if job is None:
+        return
+    if job.status in ("queued", "running"):
+        text = f"Job #{job.id} {job.status}" + (f": {job.message}" if job.message else "")
+        st.progress(job.progress, text=text)
+        if job.error:
+            st.caption(f"Attempt {job.attempts} of {job.max_attempts} failed ({job.error}); retrying.")
+    elif job.status == "failed":
+        st.error(f"Job #{job.id} failed after {job.attempts} attempts: {job.error}")
+    else:
+        st.success(job_summary(job))
+        result = json.loads(job.result)
+        if job.kind == "import_devices" and result["rejects"]:
+            st.dataframe(pd.DataFrame(result["rejects"]))
+            # The preview is capped; the full list stays next to the upload
+            if os.path.exists(result.get("rejects_file", "")):
+                with open(result["rejects_file"], "rb") as rejects_file:
+                    st.download_button(f"Download all {result['rejected']:,} rejected rows", rejects_file.read(),
+                                       file_name="rejected_rows.csv", mime="text/csv", key=f"job_{job.id}_rejects")
+    # Rerun the whole page once when the job finishes so lists and counts pick up its writes
+    previous = st.session_state.get(f"job_{job_id}_status")
+    st.session_state[f"job_{job_id}_status"] = job.status
+    if previous in ("queued", "running") and job.status in ("succeeded", "failed"):
+        st.rerun()
+
+def render_profile_panel(profile):
+    history = st.session_state.setdefault("profile_history", [])
+    summary = profile.summary()
+    history.append(summary)
+    del history[:-PROFILE_HISTORY_SIZE]
+    
+    with st.sidebar.expander("⏱ Performance", expanded=False):
+        col1, col2 = st.columns(2)
+        col1.metric("Queries", summary["queries"])
+        col2.metric("Cache hits", summary["cache_hits"])
+        col1.metric("SQL ms", f"{summary['sql_ms']:,.0f}")
+        col2.metric("Run ms", f"{summary['wall_ms']:,.0f}")
+        st.dataframe(profile.section_frame(), hide_index=True)
+        if profile.statements:
+            statements = profile.statement_frame()
+            repeated = statements[statements['Repeated']]
+            if not repeated.empty:
+                st.warning(f"{len(repeated)} statements ran {REPEATED_SQL_THRESHOLD}+ times in one section (likely N+1)")
+            st.dataframe(statements, hide_index=True)
+            st.download_button("Download Statements (CSV)", statements.to_csv(index=False), file_name="run_statements.csv")
+        st.download_button("Download Run Log (CSV)", pd.DataFrame(history).to_csv(index=False), file_name="run_log.csv")
+
 def main():
+    profile = get_run_profiler().start() if PROFILE_PANEL or PROFILE_LOG else None
+    get_job_runner()
+    
     # Page configuration
     st.set_page_config(
     page_title="xdatabyte",
@@ -110,12 +2394,23 @@ def main():
     st.markdown("---")
     
     # Sidebar navigation
-    menu = ["Device Registration", "Testing Management", "Batch Processing", "Reports & Analytics"]
+    menu = ["Device Registration", "Testing Management", "Batch Processing", "Serial History", "Reports & Analytics"]
     choice = st.sidebar.selectbox("Navigation", menu)
+    if st.sidebar.button("Refresh Data"):
+        get_query_cache().clear()
+    jobs = recent_jobs(session, 5)
+    if jobs:
+        with st.sidebar.expander("Background Jobs"):
+            for job in jobs:
+                st.caption(f"#{job.id} {job.kind.replace('_', ' ')}: {job.status}"
+                           + (f" ({job.message})" if job.status == "running" and job.message else ""))
+    if profile is not None:
+        profile.page = choice
     
     # Device Registration
     if choice == "Device Registration":
         st.markdown("#### 📝 Device Serial Number Registration")
+        profile_section("Register Device")
         
         with st.expander("Register New Device", expanded=True):
             col1, col2 = st.columns(2)
@@ -133,61 +2428,33 @@ def main():
                 if not serial_number or not model or not customer_name:
                     st.error("Please fill all required fields (marked with *)")
                 else:
-                    # Check if serial number already exists
-                    existing_report_date = session.query(Device).filter_by(report_date=report_date).first()
-                    if existing_report_date:
-                        st.error(f"Device with report_date {report_date} already exists!")
+                    # A serial number that is already registered is left untouched
+                    registered = register_device(session, {
+                        "report_date": report_date,
+                        "serial_number": serial_number,
+                        "model": model,
+                        "box_type": box_type,
+                        "customer_name": customer_name,
+                        "location": location,
+                        "in_house": in_house,
+                        "storage_days_category": calculate_storage_days_category(report_date),
+                    })
+                    if registered:
+                        st.success(f"Device {serial_number} registered successfully!")
                     else:
-                        # Create new device
-                        new_device = Device(
-                            report_date=report_date,
-                            serial_number=serial_number,
-                            model=model,
-                            box_type=box_type,
-                            customer_name=customer_name,
-                            location=location,
-                            in_house=in_house,
-                            storage_days_category=calculate_storage_days_category(report_date)
-                        )
-                        session.add(new_device)
-                        session.commit()
-                        st.success(f"report_date {report_date} registered successfully!")
+                        st.error(f"Device {serial_number} is already registered!")
+        
+        profile_section("Bulk Import")
+        with st.expander("Bulk Import (CSV/Excel)"):
+            st.caption("Columns: Serial Number*, Model*, Customer Name*, Report Date, Device Type, Location, In-House, Service Code")
+            upload = st.file_uploader("Device File", type=["csv", "xlsx"])
+            if upload is not None and st.button("Import Devices"):
+                st.session_state["import_job"] = enqueue_device_import(session, upload.name, upload.getvalue()).id
+            if "import_job" in st.session_state:
+                job_status(st.session_state["import_job"])
         
         st.subheader("Registered Devices")
-        devices = session.query(Device).all()
-        if devices:
-            devices_data = [{
-                "Report Date": device.report_date.strftime('%Y-%m-%d') if device.report_date else "",
-                "Serial Number": device.serial_number,
-                "Model": device.model,
-                "Device Type": device.box_type,
-                "Customer": device.customer_name,
-                "Location": device.location,
-                "In-House": "Yes" if device.in_house else "No",
-                "Batch Number": device.batch_number if device.batch_number else "Not assigned",
-                "Status": "Scrap" if device.is_scrap else "Active"
-            } for device in devices]
-            
-            df_devices = pd.DataFrame(devices_data)
-            
-            gb = GridOptionsBuilder.from_dataframe(df_devices)
-            gb.configure_pagination(paginationAutoPageSize=False, paginationPageSize=10)
-            gb.configure_selection('single', use_checkbox=True)
-            gb.configure_default_column(groupable=True, value=True, enableRowGroup=True, aggFunc='sum', editable=False)
-            grid_options = gb.build()
-            
-            grid_response = AgGrid(
-                df_devices,
-                gridOptions=grid_options,
-                height=400,
-                width='100%',
-                data_return_mode='FILTERED_AND_SORTED',
-                update_mode=GridUpdateMode.SELECTION_CHANGED,
-                fit_columns_on_grid_load=True,
-                theme='streamlit'
-            )
-        else:
-            st.info("No devices registered yet.")
+        grid_response = render_grid_page(session, "devices", Device, DEVICE_GRID_COLUMNS, "No devices registered yet.")
     
     # Testing Management
     elif choice == "Testing Management":
@@ -197,29 +2464,19 @@ def main():
         
         with tab1:
             st.subheader("Add New Test")
+            profile_section("Add New Test")
             
-            # Get all registered devices
-            devices = session.query(Device).filter(Device.is_scrap == False).all()
-            device_choices = {f"{d.serial_number} - {d.model} - {d.customer_name}": d.serial_number for d in devices}
-            
-            if not devices:
+            if not count_devices(session, "active"):
                 st.warning("No active devices available for testing. Please register devices first.")
             else:
-                selected_device_key = st.selectbox("Select Device", options=list(device_choices.keys()))
-                serial_number = device_choices[selected_device_key]
-                
-                device = session.query(Device).filter_by(serial_number=serial_number).first()
+                device_id = device_picker(session, "test_device", "active", "Select Device")
+                device = session.get(Device, device_id) if device_id is not None else None
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     test_date = st.date_input("Test Date", datetime.now())
-                    test_type = st.selectbox("Test Type", [
-                        "SQT", "SUMT", "SCL", "SCOSLAB", "SCOSCLEAN", "SPRETS", 
-                        "SPPOSTTS", "SPOERUP", "SCOMPLETE", "SSCAN", "SPRO", 
-                        "SFAILCOS", "SFAILTEST", "SDETSCAN", "SKIT", "SPACK", 
-                        "SSTORE", "SSHIP"
-                    ])
-                    test_location = st.selectbox("Test Location", ["Charlotte", "Sanjose", "Brownsville"])
+                    test_type = st.selectbox("Test Type", TEST_TYPES)
+                    test_location = st.selectbox("Test Location", TEST_LOCATIONS)
                 with col2:
                     rate = st.number_input("Rate ($)", min_value=0.0, format="%.2f")
                     tax = st.number_input("Tax ($)", min_value=0.0, format="%.2f", value=0.0)
@@ -228,282 +2485,403 @@ def main():
                 notes = st.text_area("Test Notes")
                 
                 if st.button("Submit Test"):
-                    new_test = Test(
-                        serial_number=serial_number,
-                        model=device.model,
-                        test_type=test_type,
-                        test_date=test_date,
-                        test_location=test_location,
-                        rate=rate,
-                        tax=tax,
-                        spare_replacement=spare_replacement,
-                        notes=notes
-                    )
-                    session.add(new_test)
-                    session.commit()
-                    st.success("Test record added successfully!")
+                    if device is None:
+                        st.error("No device matches the search. Please select a device.")
+                    else:
+                        new_test = {
+                            "serial_number": device.serial_number,
+                            "model": device.model,
+                            "test_type": test_type,
+                            "test_date": test_date,
+                            "test_location": test_location,
+                            "rate": rate,
+                            "tax": tax,
+                            "spare_replacement": spare_replacement,
+                            "notes": notes,
+                        }
+                        # A submit interrupted before the id rotates is retried with the same request id, not
+                        # recorded twice; once the row exists the next submit is a new test, even with the same values
+                        form_id = st.session_state.setdefault("test_form_id", uuid.uuid4().hex)
+                        new_test["request_id"] = job_key("test", dict(new_test, form=form_id))
+                        recorded = record_test(session, new_test)
+                        st.session_state["test_form_id"] = uuid.uuid4().hex
+                        if recorded:
+                            st.success("Test record added successfully!")
+                        else:
+                            st.info("This test was already recorded.")
         
         with tab2:
             st.subheader("Test Records")
             
-            # Get all tests
-            tests = session.query(Test).all()
-            if tests:
-                tests_data = [{
-                    "Test Date": test.test_date.strftime('%Y-%m-%d') if test.test_date else "",
-                    "Serial Number": test.serial_number,
-                    "Model": test.model,
-                    "Test Type": test.test_type,
-                    "Location": test.test_location,
-                    "Rate": f"${test.rate:.2f}",
-                    "Tax": f"${test.tax:.2f}",
-                    "Spare Parts": test.spare_replacement,
-                    "Completed": "Yes" if test.is_completed else "No",
-                    "Batch Number": test.batch_number if test.batch_number else "Not assigned"
-                } for test in tests]
-                
-                df_tests = pd.DataFrame(tests_data)
-                
-                gb = GridOptionsBuilder.from_dataframe(df_tests)
-                gb.configure_pagination(paginationAutoPageSize=False, paginationPageSize=10)
-                gb.configure_selection('single', use_checkbox=True)
-                gb.configure_default_column(groupable=True, value=True, enableRowGroup=True, aggFunc='sum', editable=False)
-                grid_options = gb.build()
-                
-                grid_response = AgGrid(
-                    df_tests,
-                    gridOptions=grid_options,
-                    height=400,
-                    width='100%',
-                    data_return_mode='FILTERED_AND_SORTED',
-                    update_mode=GridUpdateMode.SELECTION_CHANGED,
-                    fit_columns_on_grid_load=True,
-                    theme='streamlit'
-                )
-            else:
-                st.info("No test records available.")
+            grid_response = render_grid_page(session, "tests", Test, TEST_GRID_COLUMNS, "No test records available.")
     
     # Batch Processing
     elif choice == "Batch Processing":
         st.header("📦 Batch Processing")
         
-        tab1, tab2 = st.tabs(["Create Batch", "Ship Devices"])
+        tab1, tab2, tab3 = st.tabs(["Create Batch", "Ship Devices", "Archive"])
         
         with tab1:
             st.subheader("Create Batch for Completed Tests")
+            profile_section("Create Batch")
             
-            # Get devices with completed tests but no batch number
-            devices_with_tests = session.query(Device).filter(
-                Device.batch_number == None,
-                Device.is_scrap == False
-            ).all()
+            # Devices with no batch number yet
+            pending_count = count_devices(session, "pending_batch")
             
-            if not devices_with_tests:
+            if not pending_count:
                 st.info("No devices available for batch creation.")
             else:
-                device_list = [f"{d.serial_number} - {d.model} - {d.customer_name}" for d in devices_with_tests]
-                selected_device = st.selectbox("Select Device", device_list)
-                serial_number = selected_device.split(" - ")[0]
-                
-                # Get all tests for this device
-                tests = session.query(Test).filter_by(serial_number=serial_number, is_completed=False).all()
-                
-                if not tests:
-                    st.info("No pending tests for this device.")
+                # Select all previews per customer and hands the job the scope, never the serial list
+                if st.checkbox(f"Select all {pending_count:,} devices", key="batch_select_all"):
+                    job_params = select_all_params(session, "pending_batch")
+                    pending = pending_batch_preview(session, device_selection(session, "pending_batch"))
+                    selected_count, pending_devices = pending_count, int(pending["Devices"].sum())
                 else:
-                    st.markdown(f"**Pending Tests for {serial_number}**")
-                    for test in tests:
-                        st.write(f"- {test.test_type} (Rate: ${test.rate:.2f}, Tax: ${test.tax:.2f})")
-                    
-                    if st.button(f"Mark Tests as Completed and Create Batch for {serial_number}"):
-                        device = session.query(Device).filter_by(serial_number=serial_number).first()
-                        batch_number = generate_batch_number(serial_number, device.customer_name)
-                        
-                        # Update device with batch number
-                        device.batch_number = batch_number
-                        
-                        # Update all tests for this device
-                        for test in tests:
-                            test.is_completed = True
-                            test.batch_number = batch_number
+                    selected_ids = device_picker(session, "batch_devices", "pending_batch", "Select Devices", multiple=True)
+                    selected_serials = device_serials(session, "pending_batch", selected_ids) if selected_ids else []
+                    job_params = {"serials": sorted(selected_serials)} if selected_serials else None
+                    pending = pending_test_summary(session, selected_serials) if selected_serials else None
+                    selected_count, pending_devices = len(selected_serials), len(pending) if selected_serials else 0
+                
+                if job_params:
+                    if pending.empty:
+                        st.info("No pending tests for the selected devices.")
+                    else:
+                        st.markdown(f"**Pending Tests for {pending_devices:,} of {selected_count:,} selected devices**")
+                        st.dataframe(pending)
                         
-                        session.commit()
-                        st.success(f"Batch {batch_number} created successfully for device {serial_number}!")
+                        if st.button("Mark Tests as Completed and Create Batch"):
+                            job = enqueue_job(session, "create_batches", job_params)
+                            st.session_state["batch_job"] = job.id
+            
+            if "batch_job" in st.session_state:
+                job_status(st.session_state["batch_job"])
         
         with tab2:
             st.subheader("Ship Devices")
+            profile_section("Ship Devices")
             
-            # Get devices with batch numbers but not shipped
-            devices_to_ship = session.query(Device).filter(
-                Device.batch_number != None,
-                Device.ship_date == None,
-                Device.is_scrap == False
-            ).all()
+            # Devices with batch numbers but not shipped
+            ship_count = count_devices(session, "pending_ship")
             
-            if not devices_to_ship:
+            if not ship_count:
                 st.info("No devices available for shipping.")
             else:
-                device_list = [f"{d.serial_number} - {d.model} - Batch: {d.batch_number}" for d in devices_to_ship]
-                selected_device = st.selectbox("Select Device to Ship", device_list)
-                serial_number = selected_device.split(" - ")[0]
+                if st.checkbox(f"Select all {ship_count:,} devices", key="ship_select_all"):
+                    job_params, selected_count = select_all_params(session, "pending_ship"), ship_count
+                else:
+                    selected_ids = device_picker(session, "ship_devices", "pending_ship", "Select Devices to Ship", multiple=True)
+                    selected_serials = device_serials(session, "pending_ship", selected_ids) if selected_ids else []
+                    job_params, selected_count = {"serials": sorted(selected_serials)}, len(selected_serials)
                 
                 ship_date = st.date_input("Shipping Date", datetime.now())
                 
-                if st.button(f"Mark Device {serial_number} as Shipped"):
-                    device = session.query(Device).filter_by(serial_number=serial_number).first()
-                    device.ship_date = ship_date
-                    session.commit()
-                    st.success(f"Device {serial_number} shipped on {ship_date.strftime('%Y-%m-%d')}!")
+                if selected_count and st.button(f"Mark {selected_count:,} Devices as Shipped"):
+                    job = enqueue_job(session, "ship_devices", dict(job_params, ship_date=ship_date.strftime("%Y-%m-%d")))
+                    st.session_state["ship_job"] = job.id
+            
+            if "ship_job" in st.session_state:
+                job_status(st.session_state["ship_job"])
+        
+        with tab3:
+            st.subheader("Archive Shipped and Scrapped Devices")
+            profile_section("Archive")
+            
+            retention_days = st.number_input("Archive devices shipped more than this many days ago",
+                                             min_value=0, value=RETENTION_DAYS, step=30)
+            archive_count = count_archivable_devices(session, int(retention_days))
+            st.caption("Scrapped devices are archived at any age. Archived devices and tests leave the working "
+                       "pages but stay in Serial History, exports and reports; billing totals are unchanged.")
+            
+            if not archive_count:
+                st.info("No devices are due for archiving.")
+            elif st.button(f"Archive {archive_count:,} Devices"):
+                st.session_state["archive_job"] = enqueue_archive(session, int(retention_days)).id
+            
+            if "archive_job" in st.session_state:
+                job_status(st.session_state["archive_job"])
+    
+    # Serial History
+    elif choice == "Serial History":
+        st.header("🔎 Serial History")
+        profile_section("Serial Search")
+        
+        col1, col2 = st.columns([3, 2])
+        with col1:
+            scanned = st.text_input("Scan or type a serial number (prefix search)").strip()
+        with col2:
+            range_start = st.text_input("Range from (optional)").strip()
+            range_end = st.text_input("Range to (optional)").strip()
+        
+        matches = search_serials(session, scanned or None, range_start or None, range_end or None, 50) \
+            if (scanned or range_start or range_end) else []
+        
+        if scanned in matches:
+            serial_number = scanned
+        elif matches:
+            serial_number = st.selectbox(f"{len(matches)} matching serials", matches)
+        else:
+            serial_number = None
+            if scanned or range_start or range_end:
+                st.info("No serial numbers match.")
+        
+        if serial_number:
+            profile_section("Timeline")
+            timeline = device_timeline(session, serial_number)
+            st.markdown(f"**Timeline for {serial_number}**")
+            st.dataframe(timeline, use_container_width=True)
+            
+            if (timeline["Event"] == "archived").any():
+                profile_section("Archive Lookup")
+                archived_devices, archived_tests = archived_device_frames(session, serial_number)
+                st.markdown("**Archived Records**")
+                st.dataframe(archived_devices, use_container_width=True)
+                st.dataframe(archived_tests, use_container_width=True)
     
     # Reports & Analytics
     elif choice == "Reports & Analytics":
         st.header("📊 Reports & Analytics")
         
-        tab1, tab2, tab3 = st.tabs(["Device Statistics", "Test Statistics", "Financial Summary"])
+        profile_section("Analytics Snapshot")
+        snapshot = current_analytics_snapshot(session)
+        devices = snapshot.frame("devices")
+        tests = snapshot.frame("tests")
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            st.caption(f"Device and test charts use the analytics snapshot from {snapshot.built_at:%Y-%m-%d %H:%M}; "
+                       "billing figures come from the ledger.")
+        with col2:
+            if st.button("Rebuild Snapshot"):
+                st.session_state["snapshot_job"] = refresh_analytics_snapshot(session).id
+        if "snapshot_job" in st.session_state:
+            job_status(st.session_state["snapshot_job"])
+        
+        tab1, tab2, tab3, tab4 = st.tabs(["Device Statistics", "Test Statistics", "Financial Summary", "Export Data"])
         
         with tab1:
             st.subheader("Device Statistics")
+            profile_section("Device Statistics")
             
-            # Get all devices
-            devices = session.query(Device).all()
-            
-            if devices:
-                df_devices = pd.DataFrame([{
-                    "Serial Number": d.serial_number,
-                    "Model": d.model,
-                    "Customer": d.customer_name,
-                    "Location": d.location,
-                    "Status": "Scrap" if d.is_scrap else ("Shipped" if d.ship_date else "In Process"),
-                    "Days in System": (datetime.now().date() - d.report_date).days if d.report_date else 0,
-                    "Batch Number": d.batch_number if d.batch_number else "Not assigned"
-                } for d in devices])
-                
+            if len(devices):
                 col1, col2 = st.columns(2)
                 with col1:
                     st.markdown("**Devices by Model**")
-                    model_counts = df_devices['Model'].value_counts().reset_index()
-                    model_counts.columns = ['Model', 'Count']
+                    profile_section("Devices by Model")
+                    model_counts = top_n(count_by(snapshot, "devices", 'Model', 'Model'), 'Model', 'Count')
                     fig1 = px.bar(model_counts, x='Model', y='Count', color='Model')
                     st.plotly_chart(fig1, use_container_width=True)
                     
+                    summary = device_summary_frame(session)
+                    
                     st.markdown("**Devices by Status**")
-                    status_counts = df_devices['Status'].value_counts().reset_index()
-                    status_counts.columns = ['Status', 'Count']
+                    profile_section("Devices by Status")
+                    status_counts = summary.groupby('Status', as_index=False)['Count'].sum()
                     fig2 = px.pie(status_counts, values='Count', names='Status')
                     st.plotly_chart(fig2, use_container_width=True)
+                    
+                    st.markdown("**In-House Devices by Storage Age**")
+                    profile_section("In-House Devices by Storage Age")
+                    in_house = summary[summary['Status'].isin(['In Process', 'Batched'])]
+                    age_counts = in_house.groupby(['Storage Age', 'Status'], as_index=False)['Count'].sum()
+                    fig6 = px.bar(age_counts, x='Storage Age', y='Count', color='Status', barmode='stack',
+                                  category_orders={'Storage Age': ["Less than 30 days", "30 to 45 days", "45 to 90 days", "Over 90 days", "Unknown"]})
+                    st.plotly_chart(fig6, use_container_width=True)
                 
                 with col2:
                     st.markdown("**Devices by Customer**")
-                    customer_counts = df_devices['Customer'].value_counts().reset_index()
-                    customer_counts.columns = ['Customer', 'Count']
+                    profile_section("Devices by Customer")
+                    customer_counts = top_n(summary, 'Customer', 'Count')
                     fig3 = px.bar(customer_counts, x='Customer', y='Count', color='Customer')
                     st.plotly_chart(fig3, use_container_width=True)
                     
+                    st.markdown("**Devices by Location**")
+                    profile_section("Devices by Location")
+                    location_counts = top_n(summary, 'Location', 'Count')
+                    fig5 = px.bar(location_counts, x='Location', y='Count', color='Location')
+                    st.plotly_chart(fig5, use_container_width=True)
+                    
                     st.markdown("**Days in System Distribution**")
-                    fig4 = px.histogram(df_devices, x='Days in System', nbins=20)
+                    profile_section("Days in System Distribution")
+                    days_counts = device_days_in_system(snapshot)
+                    fig4 = px.bar(days_counts, x='Days in System', y='Count')
                     st.plotly_chart(fig4, use_container_width=True)
                 
                 st.markdown("**Detailed Device Data**")
-                st.dataframe(df_devices)
+                profile_section("Detailed Device Data")
+                device_details = device_report_frame(snapshot)
+                st.dataframe(device_details.head(REPORT_TABLE_ROWS))
+                if len(device_details) > REPORT_TABLE_ROWS:
+                    st.caption(f"First {REPORT_TABLE_ROWS:,} of {len(device_details):,} devices; use Export Data for the full list.")
             else:
                 st.info("No device data available for analysis.")
         
         with tab2:
             st.subheader("Test Statistics")
+            profile_section("Test Statistics")
             
-            # Get all tests
-            tests = session.query(Test).all()
-            
-            if tests:
-                df_tests = pd.DataFrame([{
-                    "Test Type": t.test_type,
-                    "Model": t.model,
-                    "Location": t.test_location,
-                    "Rate": t.rate,
-                    "Completed": "Yes" if t.is_completed else "No",
-                    "Batch Number": t.batch_number if t.batch_number else "Not assigned"
-                } for t in tests])
-                
+            if len(tests):
                 col1, col2 = st.columns(2)
                 with col1:
                     st.markdown("**Tests by Type**")
-                    test_counts = df_tests['Test Type'].value_counts().reset_index()
-                    test_counts.columns = ['Test Type', 'Count']
+                    profile_section("Tests by Type")
+                    test_counts = top_n(count_by(snapshot, "tests", 'Test Type', 'Test Type'), 'Test Type', 'Count')
                     fig1 = px.bar(test_counts, x='Test Type', y='Count', color='Test Type')
                     st.plotly_chart(fig1, use_container_width=True)
                     
                     st.markdown("**Test Completion Status**")
-                    completion_counts = df_tests['Completed'].value_counts().reset_index()
-                    completion_counts.columns = ['Completed', 'Count']
+                    profile_section("Test Completion Status")
+                    completion_counts = test_completion_counts(snapshot)
                     fig2 = px.pie(completion_counts, values='Count', names='Completed')
                     st.plotly_chart(fig2, use_container_width=True)
+                    
+                    st.markdown("**Tests by Location**")
+                    profile_section("Tests by Location")
+                    location_test_counts = top_n(count_by(snapshot, "tests", 'Location', 'Location'), 'Location', 'Count')
+                    fig5 = px.bar(location_test_counts, x='Location', y='Count', color='Location')
+                    st.plotly_chart(fig5, use_container_width=True)
                 
                 with col2:
                     st.markdown("**Tests by Model**")
-                    model_test_counts = df_tests.groupby(['Model', 'Test Type']).size().reset_index(name='Count')
+                    profile_section("Tests by Model")
+                    model_test_counts = top_n(test_counts_by_model(snapshot), 'Model', 'Count', keys=['Test Type'])
                     fig3 = px.bar(model_test_counts, x='Model', y='Count', color='Test Type', barmode='stack')
                     st.plotly_chart(fig3, use_container_width=True)
                     
                     st.markdown("**Average Rate by Test Type**")
-                    avg_rates = df_tests.groupby('Test Type')['Rate'].mean().reset_index()
+                    profile_section("Average Rate by Test Type")
+                    avg_rates = average_rate_by_test_type(snapshot)
                     fig4 = px.bar(avg_rates, x='Test Type', y='Rate', color='Test Type')
                     st.plotly_chart(fig4, use_container_width=True)
                 
+                throughput, bucket = test_throughput(snapshot)
+                st.markdown(f"**Tests per {bucket}**")
+                profile_section("Tests over Time")
+                fig6 = px.line(throughput, x=bucket, y=['Tests', 'Completed'])
+                st.plotly_chart(fig6, use_container_width=True)
+                
                 st.markdown("**Detailed Test Data**")
-                st.dataframe(df_tests)
+                profile_section("Detailed Test Data")
+                test_details = test_report_frame(snapshot)
+                st.dataframe(test_details.head(REPORT_TABLE_ROWS))
+                if len(test_details) > REPORT_TABLE_ROWS:
+                    st.caption(f"First {REPORT_TABLE_ROWS:,} of {len(test_details):,} tests; use Export Data for the full list.")
             else:
                 st.info("No test data available for analysis.")
         
         with tab3:
             st.subheader("Financial Summary")
+            profile_section("Financial Summary")
             
-            # Get completed tests with rates
-            tests = session.query(Test).filter(Test.is_completed == True).all()
-            
-            if tests:
-                df_financial = pd.DataFrame([{
-                    "Batch Number": t.batch_number,
-                    "Test Type": t.test_type,
-                    "Model": t.model,
-                    "Rate": t.rate,
-                    "Tax": t.tax,
-                    "Total": t.rate + t.tax
-                } for t in tests])
-                
+            if session.query(BatchLedger.batch_number).first():
                 col1, col2 = st.columns(2)
                 with col1:
                     st.markdown("**Revenue by Test Type**")
-                    revenue_by_test = df_financial.groupby('Test Type')['Total'].sum().reset_index()
+                    profile_section("Revenue by Test Type")
+                    revenue_by_test = top_n(ledger_revenue_by(session, BatchLedgerLine.test_type, 'Test Type'), 'Test Type', 'Total')
                     fig1 = px.bar(revenue_by_test, x='Test Type', y='Total', color='Test Type')
                     st.plotly_chart(fig1, use_container_width=True)
                     
                     st.markdown("**Total Revenue by Model**")
-                    revenue_by_model = df_financial.groupby('Model')['Total'].sum().reset_index()
+                    profile_section("Total Revenue by Model")
+                    revenue_by_model = top_n(ledger_revenue_by(session, BatchLedgerLine.model, 'Model'), 'Model', 'Total')
                     fig2 = px.pie(revenue_by_model, values='Total', names='Model')
                     st.plotly_chart(fig2, use_container_width=True)
+                    
+                    st.markdown("**Revenue by Customer**")
+                    profile_section("Revenue by Customer")
+                    revenue_by_customer = top_n(ledger_revenue_by(session, BatchLedger.customer_name, 'Customer'), 'Customer', 'Total')
+                    fig5 = px.bar(revenue_by_customer, x='Customer', y='Total', color='Customer')
+                    st.plotly_chart(fig5, use_container_width=True)
                 
                 with col2:
                     st.markdown("**Revenue by Batch**")
-                    revenue_by_batch = df_financial.groupby('Batch Number')['Total'].sum().reset_index()
-                    fig3 = px.bar(revenue_by_batch, x='Batch Number', y='Total', color='Batch Number')
+                    profile_section("Revenue by Batch")
+                    revenue_by_batch = top_n(ledger_frame(session)[['Batch Number', 'Total']].astype({'Total': float}),
+                                             'Batch Number', 'Total')
+                    fig3 = px.bar(revenue_by_batch, x='Batch Number', y='Total')
                     st.plotly_chart(fig3, use_container_width=True)
                     
                     st.markdown("**Tax vs Rate Comparison**")
-                    fig4 = px.scatter(df_financial, x='Rate', y='Tax', color='Test Type', size='Total')
+                    profile_section("Tax vs Rate Comparison")
+                    rate_tax = rate_tax_density(snapshot)
+                    fig4 = px.scatter(rate_tax, x='Rate', y='Tax', size='Total', color='Total')
                     st.plotly_chart(fig4, use_container_width=True)
                 
-                total_revenue = df_financial['Total'].sum()
-                avg_rate = df_financial['Rate'].mean()
-                total_tax = df_financial['Tax'].sum()
+                revenue, bucket = revenue_over_time(snapshot)
+                st.markdown(f"**Completed Test Revenue per {bucket}**")
+                profile_section("Revenue over Time")
+                fig6 = px.line(revenue, x=bucket, y='Revenue')
+                st.plotly_chart(fig6, use_container_width=True)
+                
+                total_revenue, avg_rate, total_tax = ledger_totals(session)
                 
                 st.metric("Total Revenue", f"${total_revenue:,.2f}")
                 st.metric("Average Test Rate", f"${avg_rate:,.2f}")
                 st.metric("Total Tax Collected", f"${total_tax:,.2f}")
                 
-                st.markdown("**Detailed Financial Data**")
-                st.dataframe(df_financial)
+                st.markdown("**Batch Ledger**")
+                profile_section("Batch Ledger")
+                ledger = ledger_frame(session).head(REPORT_TABLE_ROWS)
+                st.dataframe(ledger)
+                if len(ledger) == REPORT_TABLE_ROWS:
+                    st.caption(f"Latest {REPORT_TABLE_ROWS:,} batches; use Export Data for the full billing history.")
+                
+                st.markdown("**Invoice**")
+                profile_section("Invoice")
+                invoice_batch = st.selectbox("Batch", ledger['Batch Number'])
+                header, lines = batch_invoice(session, invoice_batch)
+                if header is not None:
+                    st.write(f"Customer: {header.customer_name} | Created: {header.created_at:%Y-%m-%d %H:%M} | Tests: {header.test_count:,}")
+                    st.dataframe(lines)
+                    st.write(f"Subtotal ${cents_to_decimal(header.subtotal_cents):,.2f} | "
+                             f"Tax ${cents_to_decimal(header.tax_cents):,.2f} | "
+                             f"**Total ${cents_to_decimal(header.total_cents):,.2f}**")
+                    st.download_button("Download Invoice (CSV)", lines.to_csv(index=False), file_name=f"invoice_{invoice_batch}.csv")
             else:
                 st.info("No financial data available for completed tests.")
+        
+        with tab4:
+            st.subheader("Export Data")
+            profile_section("Export Data")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                dataset = st.selectbox("Dataset", EXPORT_DATASETS)
+                fmt = st.selectbox("Format", EXPORT_FORMATS)
+                use_dates = st.checkbox("Filter by date range")
+                date_range = st.date_input("Date Range", (datetime.now() - timedelta(days=30), datetime.now()), disabled=not use_dates)
+            with col2:
+                export_customer = st.text_input("Customer (exact name, optional)")
+                export_batch = st.text_input("Batch Number (optional)")
+            
+            if st.button("Prepare Export"):
+                start_date, end_date = (date_range if use_dates and len(date_range) == 2 else (None, None))
+                # Rows stream to disk; only a finished file small enough to download is read back
+                with tempfile.TemporaryFile() as out:
+                    written = write_export(session, out, dataset, fmt, start_date, end_date,
+                                           export_customer.strip() or None, export_batch.strip() or None)
+                    size = out.tell()
+                    out.seek(0)
+                    data = out.read() if size <= EXPORT_DOWNLOAD_MAX_BYTES else None
+                extension = {"CSV": "csv", "XLSX": "xlsx", "Parquet": "parquet"}[fmt]
+                if data is None:
+                    st.warning(f"{written:,} rows ({size / 1024 / 1024:,.0f} MB) is too large to download here. "
+                               f"Narrow the filters or run: python export_data.py {dataset.lower()} "
+                               f"{dataset.lower()}.{extension}")
+                else:
+                    st.success(f"{written:,} rows ready.")
+                    st.download_button("Download", data, file_name=f"{dataset.lower()}_{datetime.now():%Y%m%d}.{extension}")
+    
+    if profile is not None:
+        profile.finish()
+        if PROFILE_LOG:
+            write_profile_log(profile)
+        if PROFILE_PANEL:
+            render_profile_panel(profile)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        get_run_profiler().stop()
+        Session.remove()